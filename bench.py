@@ -0,0 +1,353 @@
+"""Офлайн-бенчмарк бота на локальных заглушках Gatto и Telegram.
+
+Поднимает два HTTP-сервера, которые изображают api.nl.gatto.pw и
+api.telegram.org (задержка, доля 5xx и 429 настраиваются), направляет на них
+main.py через GATTO_API/TG_API и прогоняет сценарии:
+
+    box      — /box на N боксах
+    essence  — /essence на многих питомцах
+    day      — сутки плановых задач на ускоренных часах
+
+    python bench.py --latency 0.05 --error-rate 0.02 --throttle-rate 0.01
+
+Переменные окружения main.py (GATTO_RATE, BOX_OPEN_CONCURRENCY, ...)
+действуют как обычно — так сравниваются настройки.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+
+import schedule
+
+
+# ================= Заглушки =================
+class StubState:
+    """Склад, питомцы и журнал запросов, общие для обеих заглушек."""
+
+    def __init__(self, boxes, essences, pets, hunger_period):
+        self.lock = Lock()
+        self.hunger_period = hunger_period
+        self.fed_at = time.time()
+        self.boxes = [{"_id": f"box{i}", "name": "common"} for i in range(boxes)]
+        self.essences = [{"_id": f"ess{i}", "type": "fire"} for i in range(essences)]
+        self.pets = [{"_id": f"pet{i}", "level": random.randint(1, 9)} for i in range(pets)]
+        self.message_ids = count(1)
+        self.calls = defaultdict(int)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+    latency = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, data, headers=()):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        method = self.path.split("?")[0].rsplit("/", 1)[-1]
+        with self.state.lock:
+            self.state.calls[method] += 1
+
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return self.throttled()
+        if roll < self.throttle_rate + self.error_rate:
+            return self.reply(500, {"error": "stub failure"})
+        self.handle_method(method, payload)
+
+    def throttled(self):
+        self.reply(429, {"error": "too many requests"}, [("Retry-After", "1")])
+
+
+class GattoStub(StubHandler):
+    def handle_method(self, method, payload):
+        st = self.state
+        with st.lock:
+            if method == "warehouseGoods.getByLimit":
+                goods = st.boxes if payload.get("type") == "lootBoxes" else st.essences
+                offset, limit = payload.get("offset", 0), payload.get("limit", 50)
+                return self.reply(200, goods[offset:offset + limit])
+
+            if method == "lootBox.open":
+                before = len(st.boxes)
+                st.boxes = [b for b in st.boxes if b["_id"] != payload.get("id")]
+                if len(st.boxes) == before:
+                    return self.reply(400, {"error": "no such box"})
+                return self.reply(200, {
+                    "soft": random.randint(1, 100),
+                    "resultEggs": [{"itemType": "egg", "allowedRegion": "forest", "rarity": "common"}],
+                    "resultFoods": [{"itemType": "food", "name": "fish", "count": random.randint(1, 3)}],
+                })
+
+            if method == "essence.activate":
+                ess = [e for e in st.essences if e["_id"] == payload.get("essenceId")]
+                pet = [p for p in st.pets if p["_id"] == payload.get("petId")]
+                if not ess or not pet or pet[0]["level"] >= 10:
+                    return self.reply(400, {"error": "bad essence"})
+                st.essences.remove(ess[0])
+                pet[0]["level"] += 1
+                return self.reply(200, {"level": pet[0]["level"]})
+
+            if method == "user.getSelf":
+                regions = [{"pet": dict(p)} for p in st.pets]
+                return self.reply(200, {"user": {"regions": regions}})
+
+            if method == "user.getDailyPrize":
+                return self.reply(200, {"type": "soft", "value": 500})
+
+            if method == "pet.getAllStats":
+                # hungryAt — предполагаемое поле (см. FEED_DUE_FIELDS в main.py),
+                # настоящий ответ не сверен: экономия кормлений в сценарии day
+                # верна, только если сервер действительно отдаёт срок голода
+                hungry_at = (st.fed_at + st.hunger_period) * 1000
+                return self.reply(200, {"pets": [{"_id": p["_id"], "hungryAt": hungry_at} for p in st.pets]})
+
+            if method == "pet.feed":
+                st.fed_at = time.time()
+                return self.reply(200, {"ok": True})
+
+            if method == "pet.getPrize":
+                return self.reply(200, {"soft": 10, "resultEssence": [{"itemType": "essence", "type": "fire"}]})
+
+        # pet.play, ads.watch
+        self.reply(200, {"ok": True})
+
+
+class TelegramStub(StubHandler):
+    def throttled(self):
+        self.reply(429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 1}})
+
+    def handle_method(self, method, payload):
+        self.reply(200, {"ok": True, "result": {"message_id": next(self.state.message_ids)}})
+
+
+def start_stub(handler, state, args):
+    cls = type(handler.__name__, (handler,), {
+        "state": state,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "throttle_rate": args.throttle_rate,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", 0), cls)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ================= Замеры =================
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Recorder:
+    """Время каждого вызова Gatto глазами бота (включая ожидание лимитера)."""
+
+    def __init__(self, main):
+        self.lock = Lock()
+        self.samples = defaultdict(list)
+        original = main.gatto_post
+
+        def timed(url, payload=None):
+            started = time.monotonic()
+            try:
+                return original(url, payload)
+            finally:
+                with self.lock:
+                    self.samples[main.endpoint_of(url)].append(time.monotonic() - started)
+
+        main.gatto_post = timed
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+
+def report(name, elapsed, ops, unit, samples, state):
+    print(f"\n== {name} ==")
+    print(f"время: {elapsed:.2f} с, {unit}: {ops}, пропускная способность: {ops / elapsed:.1f} {unit}/с")
+    for endpoint, values in sorted(samples.items()):
+        print(
+            f"  {endpoint:28} n={len(values):5} "
+            f"p50={percentile(values, 50) * 1000:7.1f} мс  p99={percentile(values, 99) * 1000:7.1f} мс"
+        )
+    print(f"  запросов к заглушкам: {dict(state.calls)}")
+
+
+# ================= Сценарии =================
+def bench_box(main, state, recorder, args):
+    with state.lock:
+        state.boxes = [{"_id": f"box{i}", "name": "common"} for i in range(args.boxes)]
+    main.invalidate_inventory("lootBoxes")
+    recorder.reset()
+    state.calls.clear()
+    started = time.monotonic()
+    main.open_boxes()
+    elapsed = time.monotonic() - started
+    opened = args.boxes - len(state.boxes)
+    report(f"/box, {args.boxes} боксов", elapsed, opened, "боксов", recorder.samples, state)
+
+
+def bench_essence(main, state, recorder, args):
+    with state.lock:
+        state.pets = [{"_id": f"pet{i}", "level": random.randint(1, 9)} for i in range(args.pets)]
+        state.essences = [{"_id": f"ess{i}", "type": "fire"} for i in range(args.essences)]
+    main.invalidate_pet_roster()
+    main.invalidate_inventory("essences")
+    recorder.reset()
+    state.calls.clear()
+    started = time.monotonic()
+    main.apply_essences_to_pets()
+    elapsed = time.monotonic() - started
+    applied = args.essences - len(state.essences)
+    report(f"/essence, {args.pets} питомцев", elapsed, applied, "эссенций", recorder.samples, state)
+
+
+def bench_day(main, state, recorder, args):
+    """Сутки планировщика на ускоренных часах.
+
+    Задачи ставятся через schedule_account и запускаются schedule.run_pending,
+    как в scheduler_thread: пул job_executor, пропуск наложений, разброс
+    SCHEDULE_JITTER, reconcile_inventory и job_runs в STATE_DB. Часы
+    (time.time и datetime.now у schedule и main.py) перескакивают к следующему
+    запуску, когда пул простаивает; сетевые задержки настоящие.
+    """
+    real_time = time.time
+    offset = [0.0]
+
+    class FastDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime.now(tz) + datetime.timedelta(seconds=offset[0])
+
+    fast_module = types.ModuleType("datetime")
+    fast_module.__dict__.update(vars(datetime))
+    fast_module.datetime = FastDatetime
+    patched = [(time, "time", lambda: real_time() + offset[0]),
+               (schedule, "datetime", fast_module), (main, "datetime", FastDatetime)]
+    saved = [(obj, attr, getattr(obj, attr)) for obj, attr, _ in patched]
+
+    overlaps = [0]
+    original_log = main.log
+
+    def counting_log(msg, kind=None, **fields):
+        if kind == "job_overlap":
+            overlaps[0] += 1
+        return original_log(msg, kind, **fields)
+
+    span = 24 * 60 * 60 * args.day_scale
+    recorder.reset()
+    state.calls.clear()
+    main._traces.clear()
+    started = time.monotonic()
+    for obj, attr, value in patched:
+        setattr(obj, attr, value)
+    main.log = counting_log
+    try:
+        with state.lock:
+            state.fed_at = time.time()
+        schedule.clear()
+        for index, acc in enumerate(main.ACCOUNTS):
+            acc.feed_plan["next"] = 0.0
+            main.schedule_account(acc, index)
+        while offset[0] < span:
+            main.note_missed_runs()
+            schedule.run_pending()
+            # Пока задачи идут, часы стоят: иначе сжатые сутки наложили бы
+            # запуски, которых в настоящих сутках нет
+            while main._running_jobs:
+                time.sleep(0.01)
+            offset[0] += max(0.0, min(schedule.idle_seconds(), span - offset[0])) + 0.001
+    finally:
+        main.log = original_log
+        for obj, attr, value in saved:
+            setattr(obj, attr, value)
+        schedule.clear()
+    elapsed = time.monotonic() - started
+
+    durations = defaultdict(list)
+    for trace in list(main._traces):
+        if trace.kind == "job":
+            durations[f"job:{trace.name}"].append(trace.duration)
+            durations["queued"].append(trace.queued)
+    jobs = sum(len(v) for k, v in durations.items() if k != "queued")
+    report(f"сутки планировщика x{args.day_scale:g}", elapsed, jobs, "задач",
+           {**recorder.samples, **durations}, state)
+    print(f"  пропущено из-за наложения: {overlaps[0]}, "
+          f"записей job_runs: {main.db_execute('SELECT COUNT(*) FROM job_runs')[0][0]}")
+
+
+SCENARIOS = {"box": bench_box, "essence": bench_essence, "day": bench_day}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.05, help="средняя задержка заглушек, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--boxes", type=int, default=500)
+    parser.add_argument("--pets", type=int, default=40)
+    parser.add_argument("--essences", type=int, default=300)
+    parser.add_argument("--day-scale", type=float, default=1.0, help="доля суток для сценария day")
+    parser.add_argument("--hunger-period", type=float, default=4 * 3600, help="через сколько секунд после еды питомцы голодны")
+    parser.add_argument("--scenarios", default="box,essence,day")
+    args = parser.parse_args()
+
+    state = StubState(args.boxes, args.essences, args.pets, args.hunger_period)
+    workdir = tempfile.mkdtemp(prefix="gt-bot-bench-")
+    os.environ.update({
+        "GATTO_API": start_stub(GattoStub, state, args),
+        "TG_API": start_stub(TelegramStub, state, args),
+        "TELEGRAM_TOKEN": "bench",
+        "TG_TOKEN": "bench",
+        "CHAT_ID": "1",
+        "BOT_ROLE": "web",
+        "STATE_DB": os.path.join(workdir, "state.sqlite3"),
+    })
+    # Часы в сценарии day ускорены, а кеш статистики живёт по monotonic —
+    # без этого сутки запросов схлопнулись бы в один
+    os.environ.setdefault("STATS_TTL", "0")
+    os.environ.setdefault("LOG_FORMAT", "text")
+    # Сценарий day берёт длительности задач из буфера трасс
+    os.environ.setdefault("TRACE_BUFFER", "100000")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as bot
+
+    recorder = Recorder(bot)
+    for name in args.scenarios.split(","):
+        SCENARIOS[name.strip()](bot, state, recorder, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,107 +1,1225 @@
+import atexit
+import fcntl
+import hashlib
+import hmac
+import json
 import os
+import random
+import re
 import requests
+import sqlite3
 import schedule
+import sys
 import time
-from datetime import datetime
-from threading import Thread
-from flask import Flask, request
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timedelta
+from itertools import count
+from queue import Empty, Full, Queue
+from threading import BoundedSemaphore, Event, Lock, Thread, get_ident
+from urllib.parse import urlsplit
+from flask import Flask, Response, jsonify, request
+from requests.adapters import HTTPAdapter
 
 # ================= Конфигурация =================
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
-CHAT_ID = int(os.environ.get("CHAT_ID"))
+CHAT_ID = int(os.environ["CHAT_ID"]) if os.environ.get("CHAT_ID") else None
 TG_TIMEOUT = 3
+TG_MESSAGE_LIMIT = 4096
+TG_CHAT_INTERVAL = 1.0  # Telegram: ~1 сообщение в секунду в один чат
+TG_COALESCE_WINDOW = float(os.environ.get("TG_COALESCE_WINDOW", 1.0))
 GATTO_TIMEOUT = 20
 MAX_RETRIES = 3
-RETRY_DELAY = 3
+BACKOFF_BASE = 1.0  # секунд; задержка перед повтором растёт как base * 2^попытка
+BACKOFF_MAX = 15.0
+# Дольше этого Retry-After не ждём: запрос считается неудачным
+RETRY_AFTER_MAX = float(os.environ.get("RETRY_AFTER_MAX", BACKOFF_MAX))
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", 5))  # сбоев подряд
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 60))  # секунд до пробного запроса
 APPLY_TIME = "03:00"
 
+# Пул соединений и ограничение параллельности для Gatto
+GATTO_POOL_SIZE = int(os.environ.get("GATTO_POOL_SIZE", 16))
+GATTO_HOST_CONCURRENCY = int(os.environ.get("GATTO_HOST_CONCURRENCY", 8))
+GATTO_WORKERS = int(os.environ.get("GATTO_WORKERS", 8))
+
+# Общий адаптивный лимит запросов к Gatto (запросов в секунду)
+GATTO_RATE = float(os.environ.get("GATTO_RATE", 5))
+GATTO_RATE_MIN = float(os.environ.get("GATTO_RATE_MIN", 0.5))
+GATTO_RATE_MAX = float(os.environ.get("GATTO_RATE_MAX", 20))
+GATTO_RATE_BURST = int(os.environ.get("GATTO_RATE_BURST", 4))
+
+# Склад и открытие боксов
+WAREHOUSE_PAGE_SIZE = int(os.environ.get("WAREHOUSE_PAGE_SIZE", 50))
+# Типы склада в индексе инвентаря и как часто сверять индекс со складом
+INVENTORY_TYPES = os.environ.get("INVENTORY_TYPES", "lootBoxes,essences").split(",")
+INVENTORY_TTL = float(os.environ.get("INVENTORY_TTL", 60 * 60))  # секунд
+INVENTORY_RECONCILE = int(os.environ.get("INVENTORY_RECONCILE", 30 * 60))  # секунд
+BOX_OPEN_CONCURRENCY = int(os.environ.get("BOX_OPEN_CONCURRENCY", 4))
+BOX_MAX_PASSES = 5
+BOX_PROGRESS_INTERVAL = float(os.environ.get("BOX_PROGRESS_INTERVAL", 3))  # секунд между правками
+
+# Эссенции
+MAX_PET_LEVEL = 10
+ESSENCE_CONCURRENCY = int(os.environ.get("ESSENCE_CONCURRENCY", 4))
+ESSENCE_MAX_FAILURES = 3  # неудач подряд, после которых питомец выбывает из прогона
+
+# Реклама после игр: сколько ads.watch одновременно
+ADS_CONCURRENCY = int(os.environ.get("ADS_CONCURRENCY", 8))
+
+# Планировщик
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 4))
+SCHEDULE_JITTER = int(os.environ.get("SCHEDULE_JITTER", 10))  # секунд
+
+# Несколько аккаунтов: JSON-список [{"name", "token", "chat_id"}] в ACCOUNTS
+# или в файле ACCOUNTS_FILE; без них — один аккаунт из TG_TOKEN и CHAT_ID
+ACCOUNTS_JSON = os.environ.get("ACCOUNTS")
+ACCOUNTS_FILE = os.environ.get("ACCOUNTS_FILE")
+ACCOUNT_STAGGER = float(os.environ.get("ACCOUNT_STAGGER", 10))  # секунд между аккаунтами
+ACCOUNT_FAILURE_LIMIT = int(os.environ.get("ACCOUNT_FAILURE_LIMIT", 5))  # неудачных задач подряд
+ACCOUNT_PAUSE = float(os.environ.get("ACCOUNT_PAUSE", 10 * 60))  # секунд паузы после них
+
+# Webhook и команды
+COMMAND_WORKERS = int(os.environ.get("COMMAND_WORKERS", 2))  # быстрые: /stats, /inventory
+WEBHOOK_DEDUP_SIZE = 1000
+# Долгие команды в STATE_DB: как часто запуск отмечается и проверяет /cancel,
+# и через сколько секунд без отметки запуск считается брошенным
+COMMAND_SYNC_INTERVAL = 1.0
+COMMAND_STALE = 120
+TG_REPLY_IN_WEBHOOK = os.environ.get("TG_REPLY_IN_WEBHOOK") == "1"
+
+# Логи: json — по записи JSON на строку, text — прежний человекочитаемый вид
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = 10000  # записей; при переполнении новые отбрасываются
+# Частые сообщения одного типа (kind): не больше LOG_KIND_LIMIT за окно на аккаунт
+LOG_KIND_LIMIT = int(os.environ.get("LOG_KIND_LIMIT", 5))
+LOG_KIND_WINDOW = float(os.environ.get("LOG_KIND_WINDOW", 10 * 60))  # секунд
+
+# Трассировка задач и команд для /debug/jobs
+# Секрет для /debug/*: заголовок X-Debug-Token; без него маршруты отключены
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN")
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", 200))  # последних запусков в памяти
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", 200))  # спанов на запуск
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.01))  # секунд между снимками стеков
+PROFILE_TOP = 15
+
+# Выбор лидера между воркерами gunicorn
+LEADER_LOCK_PATH = os.environ.get("LEADER_LOCK_PATH", "/tmp/gt-bot.leader.lock")
+LEADER_POLL_INTERVAL = 5
+# auto — участвовать в выборах лидера; web — только обслуживать /webhook
+BOT_ROLE = os.environ.get("BOT_ROLE", "auto")
+
+# Старт: кеш регистрации в Telegram и интервал между стартовыми задачами
+TG_REGISTRATION_CACHE = os.environ.get("TG_REGISTRATION_CACHE", "/tmp/gt-bot.tg-registration")
+INITIAL_STAGGER = float(os.environ.get("INITIAL_STAGGER", 15))  # секунд
+
+# SQLite с состоянием задач; чтобы переживать редеплой, укажите путь на volume
+STATE_DB = os.environ.get("STATE_DB", "/tmp/gt-bot.sqlite3")
+
+# Кормление: частая бесплатная проверка срока, сам pet.feed — по статистике
+FEED_CHECK_INTERVAL = 30
+FEED_FALLBACK_INTERVAL = int(os.environ.get("FEED_FALLBACK_INTERVAL", 2 * 60))
+FEED_MIN_INTERVAL = 60
+FEED_MAX_INTERVAL = int(os.environ.get("FEED_MAX_INTERVAL", 60 * 60))
+FEED_LEAD = 30  # кормим чуть раньше срока
+# Имена полей — предположение: в коде нет ни одного настоящего ответа
+# pet.getAllStats, по которому их можно сверить. Если ни одно не найдётся,
+# feed_cat один раз предупредит в логе и кормит по старой схеме, раз в
+# FEED_FALLBACK_INTERVAL; настоящие имена задаются через окружение.
+FEED_DUE_FIELDS = os.environ.get("FEED_DUE_FIELDS", "hungryAt,nextFeedAt,feedAvailableAt").split(",")
+SATIETY_FIELDS = os.environ.get("SATIETY_FIELDS", "satiety,fullness").split(",")
+FEED_SATIETY_THRESHOLD = float(os.environ.get("FEED_SATIETY_THRESHOLD", 30))
+
+# Сколько секунд ответ pet.getAllStats считается свежим
+STATS_TTL = float(os.environ.get("STATS_TTL", 60))
+# Сколько секунд список питомцев из user.getSelf живёт без перечитывания
+ROSTER_TTL = float(os.environ.get("ROSTER_TTL", 6 * 3600))
+
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # https://app.up.railway.app/webhook
+# Базовые адреса API можно подменить (например, на заглушки из bench.py)
+GATTO_API = os.environ.get("GATTO_API", "https://api.nl.gatto.pw")
+TG_API = os.environ.get("TG_API", "https://api.telegram.org")
 TG_TOKEN = os.environ.get("TG_TOKEN")
 
+# Общие заголовки Gatto; authorization у каждого аккаунта свой
 HEADERS = {
     "accept": "application/json, text/plain, */*",
-    "authorization": f"Bearer {TG_TOKEN}",
     "content-type": "application/json",
     "referer": "https://gatto.pw/",
     "user-agent": "Mozilla/5.0"
 }
 
-tg = requests.Session()
-gatto = requests.Session()
+
+def make_session(pool_size):
+    """Session с keep-alive пулом нужного размера (по умолчанию у requests всего 10)."""
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+tg = make_session(4)
+gatto = make_session(GATTO_POOL_SIZE)
+
+
+# ================= Логи =================
+# log() только собирает запись и кладёт её в очередь — в горячем пути нет ни
+# форматирования, ни записи в stdout. Пишет единственный поток log_writer.
+log_queue = Queue(maxsize=LOG_QUEUE_SIZE)
+_log_dropped = [0]
+_log_dropped_lock = Lock()
+_log_write_lock = Lock()
+_log_windows = {}  # (kind, аккаунт) -> [начало окна, записано, подавлено]
+
+
+def log(msg, kind=None, level="info", **fields):
+    """Структурированная запись: время, уровень, текст, аккаунт и задача из
+    контекста, плюс fields (например endpoint). kind — тип частого сообщения,
+    такие прореживаются: LOG_KIND_LIMIT за LOG_KIND_WINDOW секунд."""
+    record = {"ts": time.time(), "level": level, "msg": msg}
+    acc = current_account.get()
+    if acc is not None:
+        record["account"] = acc.name
+    trace = current_trace.get()
+    if trace is not None:
+        record["job"] = trace.name.rsplit(":", 1)[-1]
+    if kind is not None:
+        record["kind"] = kind
+    record.update(fields)
+    try:
+        log_queue.put_nowait(record)
+    except Full:
+        with _log_dropped_lock:
+            _log_dropped[0] += 1
+
+
+def log_allowed(record):
+    """Окно на (kind, аккаунт); первая запись нового окна несёт число
+    подавленных в прошлом."""
+    kind = record.get("kind")
+    if kind is None:
+        return True
+    key = (kind, record.get("account"))
+    window = _log_windows.get(key)
+    if window is None or record["ts"] - window[0] >= LOG_KIND_WINDOW:
+        if window is not None and window[2]:
+            record["suppressed"] = window[2]
+        window = _log_windows[key] = [record["ts"], 0, 0]
+    if window[1] >= LOG_KIND_LIMIT:
+        window[2] += 1
+        return False
+    window[1] += 1
+    return True
+
+
+def format_log_record(record):
+    ts = datetime.fromtimestamp(record["ts"])
+    if LOG_FORMAT == "text":
+        prefix = f"[{record['account']}] " if "account" in record and len(ACCOUNTS) > 1 else ""
+        return f"[{ts:%Y-%m-%d %H:%M:%S}] {prefix}{record['msg']}"
+    return json.dumps(
+        dict(record, ts=ts.isoformat(timespec="milliseconds")), ensure_ascii=False, default=str
+    )
 
 
-# ================= Утилиты =================
-def now():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def write_log_records(records):
+    with _log_dropped_lock:
+        dropped, _log_dropped[0] = _log_dropped[0], 0
+    if dropped:
+        records.append({"ts": time.time(), "level": "warning", "msg": "очередь логов переполнена", "dropped": dropped})
+    with _log_write_lock:
+        lines = [format_log_record(r) for r in records if log_allowed(r)]
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
 
 
-def log(msg):
-    print(f"[{now()}] {msg}")
+def drain_log_queue(limit=None):
+    records = []
+    while limit is None or len(records) < limit:
+        try:
+            records.append(log_queue.get_nowait())
+        except Empty:
+            break
+    return records
 
 
-def tg_send_long(text):
-    """Отправляет длинное сообщение, разбивая на блоки <4096 символов."""
-    limit = 3900
-    parts = [text[i:i+limit] for i in range(0, len(text), limit)]
-    for part in parts:
+def log_writer():
+    """Пишет записи пачками: одна запись в stdout на всё, что накопилось."""
+    while True:
+        records = [log_queue.get()]
+        records.extend(drain_log_queue(limit=500))
         try:
-            tg.post(
-                f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-                json={"chat_id": CHAT_ID, "text": part},
+            write_log_records(records)
+        except Exception as e:
+            print(f"log writer error: {e}", file=sys.stderr)
+
+
+@atexit.register
+def flush_logs():
+    """Остаток очереди при выходе процесса (поток-писатель — daemon)."""
+    write_log_records(drain_log_queue())
+
+
+# ================= Аккаунты =================
+DEFAULT_ACCOUNT = "default"
+
+
+class Account:
+    """Аккаунт Gatto: свой токен, свой чат и свои кеши.
+
+    Пул соединений, лимитер и предохранители общие для всех аккаунтов.
+    """
+
+    def __init__(self, name, token, chat_id):
+        self.name = name
+        self.chat_id = chat_id
+        self.headers = dict(HEADERS, authorization=f"Bearer {token}")
+        # Кеш pet.getAllStats
+        self.stats = {"data": None, "at": 0.0}
+        self.stats_lock = Lock()
+        # Питомцы из user.getSelf
+        self.roster = {"pets": {}, "at": 0.0, "valid": False}
+        self.roster_lock = Lock()
+        self.roster_refresh_lock = Lock()
+        # Когда снова проверять голод (time.time()); 0 — проверить при первом запуске
+        # fallback_warned — уже предупредили, что статистика не разбирается
+        self.feed_plan = {"next": 0.0, "fallback_warned": False}
+        # Индекс склада: тип -> {"items": {_id: предмет}, "at", "valid", "pending"}
+        self.inventory = {}
+        self.inventory_lock = Lock()
+        self.inventory_refresh_lock = Lock()
+        # Неудачные задачи подряд и пауза после ACCOUNT_FAILURE_LIMIT таких
+        self.failures = 0
+        self.paused_until = 0.0
+        self.lock = Lock()
+        # Задачи аккаунта в пуле и ждущие своей очереди (под _running_lock)
+        self.jobs_in_flight = 0
+        self.pending_jobs = deque()
+
+    def job_key(self, name):
+        """Имя задачи в job_runs; у аккаунта по умолчанию — без префикса,
+        чтобы состояние однопользовательской установки не потерялось."""
+        return name if self.name == DEFAULT_ACCOUNT else f"{self.name}:{name}"
+
+    def tag(self, text):
+        """Подписывает сообщение именем аккаунта, если аккаунтов несколько."""
+        return f"👤 {self.name}\n{text}" if len(ACCOUNTS) > 1 else text
+
+    def job_done(self, ok):
+        """Учитывает исход задачи. True — аккаунт только что ушёл на паузу."""
+        with self.lock:
+            if ok:
+                self.failures = 0
+                return False
+            self.failures += 1
+            if self.failures < ACCOUNT_FAILURE_LIMIT:
+                return False
+            self.failures = 0
+            self.paused_until = time.time() + ACCOUNT_PAUSE
+            return True
+
+    def paused(self):
+        return time.time() < self.paused_until
+
+
+def load_accounts():
+    if ACCOUNTS_FILE:
+        with open(ACCOUNTS_FILE) as f:
+            entries = json.load(f)
+    elif ACCOUNTS_JSON:
+        entries = json.loads(ACCOUNTS_JSON)
+    else:
+        entries = [{"name": DEFAULT_ACCOUNT, "token": TG_TOKEN, "chat_id": CHAT_ID}]
+
+    accounts = []
+    for i, entry in enumerate(entries):
+        name = str(entry.get("name") or f"account{i + 1}")
+        if not entry.get("token") or entry.get("chat_id") is None:
+            raise ValueError(f"Аккаунт {name}: нужны token и chat_id")
+        if any(a.name == name for a in accounts):
+            raise ValueError(f"Аккаунт {name} указан дважды")
+        accounts.append(Account(name, entry["token"], int(entry["chat_id"])))
+    if not accounts:
+        raise ValueError("Список аккаунтов пуст")
+    return accounts
+
+
+ACCOUNTS = load_accounts()
+
+# Несколько аккаунтов могут присылать уведомления в один чат
+ACCOUNTS_BY_CHAT = defaultdict(list)
+for _acc in ACCOUNTS:
+    ACCOUNTS_BY_CHAT[_acc.chat_id].append(_acc)
+
+# Аккаунт, от имени которого работает текущая задача или команда
+current_account = ContextVar("current_account", default=None)
+
+
+def account():
+    """Текущий аккаунт; вне задач и команд (bench, ручной вызов) — первый."""
+    return current_account.get() or ACCOUNTS[0]
+
+
+def in_account(acc, fn, *args):
+    """Выполняет fn(*args) от имени acc."""
+    token = current_account.set(acc)
+    try:
+        return fn(*args)
+    finally:
+        current_account.reset(token)
+
+
+# ================= Метрики =================
+class Metrics:
+    """Счётчики, gauge и гистограммы в текстовом формате Prometheus.
+
+    Всё в памяти процесса; под gunicorn каждый воркер отдаёт свои значения.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.meta = {}
+        self.values = defaultdict(float)  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики бакетов..., сумма, количество]
+
+    def describe(self, name, kind, help_text):
+        self.meta[name] = (kind, help_text)
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.values[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                h = self.histograms[(name, labels)] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        with self.lock:
+            values = list(self.values.items())
+            histograms = [(key, list(h)) for key, h in self.histograms.items()]
+
+        out = []
+        for name, (kind, help_text) in sorted(self.meta.items()):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for (n, labels), v in sorted(values):
+                if n == name:
+                    out.append(f"{name}{fmt(labels)} {v:g}")
+            for (n, labels), h in sorted(histograms):
+                if n != name:
+                    continue
+                for bound, count in zip(self.BUCKETS, h):
+                    out.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {count}")
+                out.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h[-1]}")
+                out.append(f"{name}_sum{fmt(labels)} {h[-2]:g}")
+                out.append(f"{name}_count{fmt(labels)} {h[-1]}")
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+for _api in ("gatto", "telegram"):
+    metrics.describe(f"{_api}_request_duration_seconds", "histogram", f"Время запроса к {_api} по методу API")
+    metrics.describe(f"{_api}_responses_total", "counter", f"Ответы {_api} по методу и HTTP-коду")
+    metrics.describe(f"{_api}_exceptions_total", "counter", f"Исключения при запросах к {_api} по типу")
+    metrics.describe(f"{_api}_retries_total", "counter", f"Повторные попытки запросов к {_api}")
+    metrics.describe(f"{_api}_in_flight", "gauge", f"Запросы к {_api}, ожидающие ответа")
+metrics.describe("gatto_circuit_rejections_total", "counter", "Запросы, отклонённые разомкнутым предохранителем")
+
+
+def instrumented(api, endpoint, call):
+    """Выполняет call() с замером времени, кодов ответа и исключений."""
+    labels = (("endpoint", endpoint),)
+    metrics.inc(f"{api}_in_flight", labels)
+    started = time.monotonic()
+    try:
+        with span("network", f"{api}:{endpoint}"):
+            r = call()
+    except Exception as e:
+        metrics.inc(f"{api}_exceptions_total", labels + (("error", type(e).__name__),))
+        raise
+    finally:
+        metrics.observe(f"{api}_request_duration_seconds", labels, time.monotonic() - started)
+        metrics.inc(f"{api}_in_flight", labels, -1)
+    metrics.inc(f"{api}_responses_total", labels + (("status", r.status_code),))
+    return r
+
+
+# ================= Трассировка =================
+class Sampler:
+    """Сэмплирующий профилировщик одного запуска.
+
+    Раз в PROFILE_INTERVAL снимает стеки потоков, которые работают на этот
+    запуск (поток задачи и его вызовы в gatto_map).
+    """
+
+    def __init__(self):
+        self.threads = set()
+        self.stacks = Counter()
+        self.lines = Counter()
+        self.samples = 0
+        self.stopped = Event()
+        self.lock = Lock()
+
+    def attach(self, tid):
+        with self.lock:
+            self.threads.add(tid)
+
+    def detach(self, tid):
+        with self.lock:
+            self.threads.discard(tid)
+
+    def start(self):
+        Thread(target=self.run, daemon=True, name="profiler").start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            frames = sys._current_frames()
+            with self.lock:
+                threads = list(self.threads)
+            for tid in threads:
+                frame = frames.get(tid)
+                if frame is None:
+                    continue
+                top = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                with self.lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+                    self.lines[top] += 1
+                    self.samples += 1
+
+    def report(self):
+        with self.lock:
+            return {
+                "interval": PROFILE_INTERVAL,
+                "samples": self.samples,
+                "top_lines": self.lines.most_common(PROFILE_TOP),
+                "top_stacks": self.stacks.most_common(PROFILE_TOP),
+            }
+
+
+class Trace:
+    """Один запуск задачи или команды.
+
+    Спаны — дочерние вызовы Gatto и Telegram (network), ожидания лимитера,
+    паузы и backoff (sleep) и разбор ответов (parse). Время фаз суммируется
+    по всем потокам запуска, поэтому при параллельных вызовах может быть
+    больше длительности самого запуска.
+    """
+
+    def __init__(self, name, kind, account, lag=None, queued=0.0):
+        self.id = next(_trace_ids)
+        self.name = name
+        self.kind = kind
+        self.account = account
+        self.lag = lag
+        self.queued = queued
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration = None
+        self.outcome = None
+        self.phases = defaultdict(float)
+        self.calls = {}  # фаза:имя -> [количество, секунды]
+        self.spans = []
+        self.dropped = 0
+        self.profile = None
+        self.lock = Lock()
+
+    def add(self, kind, name, started, duration):
+        with self.lock:
+            self.phases[kind] += duration
+            call = self.calls.setdefault(f"{kind}:{name}", [0, 0.0])
+            call[0] += 1
+            call[1] += duration
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append((kind, name, started - self.started, duration))
+            else:
+                self.dropped += 1
+
+    def as_dict(self, spans=False):
+        with self.lock:
+            duration = self.duration if self.duration is not None else time.monotonic() - self.started
+            d = {
+                "id": self.id,
+                "name": self.name,
+                "kind": self.kind,
+                "account": self.account,
+                "started": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+                "lag": None if self.lag is None else round(self.lag, 3),
+                "queued": round(self.queued, 3),
+                "duration": round(duration, 3),
+                "outcome": self.outcome or "running",
+                "phases": {kind: round(v, 3) for kind, v in self.phases.items()},
+                "calls": {name: {"count": n, "seconds": round(t, 3)} for name, (n, t) in self.calls.items()},
+            }
+            if spans:
+                d["spans"] = [
+                    {"kind": kind, "name": name, "at": round(at, 3), "duration": round(dur, 3)}
+                    for kind, name, at, dur in self.spans
+                ]
+                d["spans_dropped"] = self.dropped
+        if self.profile is not None:
+            d["profile"] = self.profile.report()
+        return d
+
+
+_traces = deque(maxlen=TRACE_BUFFER)  # завершённые запуски, новые в конце
+_active_traces = {}  # id -> Trace
+_traces_lock = Lock()
+_trace_ids = count(1)
+_profile_armed = set()  # имена задач, следующий запуск которых профилируется
+_job_lag = {}  # задача -> задержка старта относительно расписания
+
+current_trace = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(kind, name):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(kind, name, started, time.monotonic() - started)
+
+
+def traced_sleep(seconds, name):
+    with span("sleep", name):
+        time.sleep(seconds)
+
+
+def traced_call(fn, *args):
+    """fn(*args); если текущий запуск профилируется, поток попадает в выборку."""
+    trace = current_trace.get()
+    profile = trace.profile if trace is not None else None
+    if profile is None:
+        return fn(*args)
+    tid = get_ident()
+    profile.attach(tid)
+    try:
+        return fn(*args)
+    finally:
+        profile.detach(tid)
+
+
+def start_trace(name, kind, lag=None, queued=0.0):
+    trace = Trace(name, kind, account().name, lag, queued)
+    with _traces_lock:
+        _active_traces[trace.id] = trace
+        if name in _profile_armed:
+            _profile_armed.discard(name)
+            trace.profile = Sampler()
+    if trace.profile is not None:
+        trace.profile.start()
+    return trace
+
+
+def finish_trace(trace, outcome, keep=True):
+    """keep=False — запуск не сохраняется (пустые проверки feed_cat).
+
+    Профиль такого запуска выбрасывается, а задача снова ждёт профилирования
+    до первого запуска с настоящей работой.
+    """
+    trace.duration = time.monotonic() - trace.started
+    trace.outcome = outcome
+    if trace.profile is not None:
+        trace.profile.stop()
+    with _traces_lock:
+        _active_traces.pop(trace.id, None)
+        if keep:
+            _traces.append(trace)
+        elif trace.profile is not None:
+            _profile_armed.add(trace.name)
+
+
+def note_job_lag(name, lag):
+    with _traces_lock:
+        stat = _job_lag.setdefault(name, {"last": 0.0, "max": 0.0, "runs": 0})
+        stat["last"] = round(lag, 3)
+        stat["max"] = max(stat["max"], stat["last"])
+        stat["runs"] += 1
+
+
+def arm_profile(name):
+    with _traces_lock:
+        _profile_armed.add(name)
+
+
+def traces_snapshot(limit=20, name=None, spans=False):
+    with _traces_lock:
+        running = list(_active_traces.values())
+        recent = [t for t in reversed(_traces) if name in (None, t.name)][:limit]
+        lag = {job: dict(stat) for job, stat in _job_lag.items()}
+        armed = sorted(_profile_armed)
+    return {
+        "running": [t.as_dict(spans) for t in running if name in (None, t.name)],
+        "recent": [t.as_dict(spans) for t in recent],
+        "scheduler_lag": lag,
+        "profile_armed": armed,
+    }
+
+
+# ================= Telegram =================
+def utf16_len(text):
+    """Длина в единицах UTF-16 — так Telegram считает лимит сообщения."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_message(text, limit=TG_MESSAGE_LIMIT):
+    """Режет текст на части не длиннее limit, по возможности по границам строк."""
+    parts = []
+    current = ""
+    for line in text.split("\n"):
+        candidate = f"{current}\n{line}" if current else line
+        if utf16_len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            parts.append(current)
+        # Строка сама по себе длиннее лимита — режем посимвольно
+        current = ""
+        for ch in line:
+            if utf16_len(current) + utf16_len(ch) > limit:
+                parts.append(current)
+                current = ""
+            current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+_tg_next_send = {}
+_tg_pace_lock = Lock()
+
+
+def tg_pace(chat_id):
+    """Не чаще одного сообщения в TG_CHAT_INTERVAL секунд в один чат."""
+    with _tg_pace_lock:
+        t = time.monotonic()
+        at = max(t, _tg_next_send.get(chat_id, 0))
+        _tg_next_send[chat_id] = at + TG_CHAT_INTERVAL
+    if at > t:
+        traced_sleep(at - t, "telegram_pace")
+
+
+def tg_call(method, payload):
+    """Синхронный вызов Bot API. Возвращает result или None при ошибке.
+
+    На 429 ждёт retry_after из ответа и повторяет.
+    """
+    for attempt in range(MAX_RETRIES):
+        if attempt:
+            metrics.inc("telegram_retries_total", (("endpoint", method),))
+        if "chat_id" in payload:
+            tg_pace(payload["chat_id"])
+        try:
+            r = instrumented("telegram", method, lambda: tg.post(
+                f"{TG_API}/bot{TELEGRAM_TOKEN}/{method}",
+                json=payload,
                 timeout=TG_TIMEOUT
-            )
+            ))
+            data = parse_json(r)
         except Exception as e:
-            log(f"Telegram send error: {e}")
+            log(f"Telegram {method} error: {e}", level="warning", endpoint=method)
+            continue
+        if data.get("ok"):
+            return data.get("result")
+        retry_after = data.get("parameters", {}).get("retry_after")
+        if retry_after and retry_after > RETRY_AFTER_MAX:
+            log(f"Telegram {method}: flood control на {retry_after} с — не жду", level="warning", endpoint=method)
+            return None
+        if retry_after:
+            log(f"Telegram {method}: flood control, жду {retry_after} с", level="warning", endpoint=method)
+            traced_sleep(retry_after, "telegram_retry_after")
+            continue
+        log(f"Telegram {method} error: {data.get('description')}", level="warning", endpoint=method)
+        return None
+    return None
+
+
+def tg_send_long(text, chat_id=None):
+    """Отправляет длинное сообщение, разбивая на блоки по границам строк."""
+    for part in split_message(text):
+        tg_call("sendMessage", {"chat_id": chat_id or account().chat_id, "text": part})
+
+
+# ================= Очередь исходящих сообщений =================
+tg_queue = Queue()
 
 
-def send_telegram(text):
-    tg_send_long(text)
+def send_telegram(text, chat_id=None):
+    """Ставит сообщение в очередь и сразу возвращается.
+
+    Без chat_id сообщение уходит в чат текущего аккаунта, с его подписью.
+    """
+    if chat_id is None:
+        acc = account()
+        chat_id, text = acc.chat_id, acc.tag(text)
+    tg_queue.put((chat_id, text))
+
+
+def telegram_sender():
+    """Единственный поток, который пишет в Telegram.
+
+    Сообщения, пришедшие в течение TG_COALESCE_WINDOW после первого,
+    склеиваются в одно на каждый чат — всплеск мелких уведомлений уходит
+    одним-двумя запросами вместо десятка.
+    """
+    while True:
+        chat_id, text = tg_queue.get()
+        batches = {chat_id: [text]}
+        deadline = time.monotonic() + TG_COALESCE_WINDOW
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                chat_id, text = tg_queue.get(timeout=remaining)
+            except Empty:
+                break
+            batches.setdefault(chat_id, []).append(text)
+
+        for chat_id, texts in batches.items():
+            try:
+                tg_send_long("\n\n".join(texts), chat_id)
+            except Exception as e:
+                log(f"Telegram send error: {e}", level="error")
 
 
 # ================= Запросы к Gatto =================
-def safe_request(url, payload=None):
-    for _ in range(MAX_RETRIES):
+class RateLimiter:
+    """Адаптивный token bucket (AIMD).
+
+    Пока ответы здоровые, скорость растёт на step; на 429/5xx/ошибке сети
+    падает вдвое, на росте задержки — на 20%. После сбоя ведро опустошается,
+    поэтому следующий запрос (в том числе повтор) ждёт своей очереди.
+    """
+
+    def __init__(self, rate, min_rate, max_rate, burst=1, step=0.2):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.step = step
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.latency = None  # EWMA задержки здоровых ответов
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            t = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (t - self.updated) * self.rate)
+            self.updated = t
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            traced_sleep(delay, "rate_limit")
+
+    def pause(self, seconds):
+        """Сервер попросил подождать (Retry-After) — ждут все запросы."""
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def report(self, status, latency):
+        """status — HTTP-код ответа или None, если запрос упал."""
+        with self.lock:
+            if status is None or status == 429 or status >= 500:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+                return
+            # Рост задержки считаем только заметный: миллисекундный шум не в счёт
+            if self.latency is not None and latency > max(self.latency * 2, 0.5):
+                self.rate = max(self.min_rate, self.rate * 0.8)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.step)
+            self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+
+
+gatto_limiter = RateLimiter(GATTO_RATE, GATTO_RATE_MIN, GATTO_RATE_MAX, burst=GATTO_RATE_BURST)
+
+
+_host_slots = {}
+_host_slots_lock = Lock()
+
+# Общий пул потоков для параллельных вызовов Gatto (только "листовые" вызовы:
+# задачи внутри пула не должны сами ждать других задач этого же пула)
+gatto_executor = ThreadPoolExecutor(max_workers=GATTO_WORKERS, thread_name_prefix="gatto")
+
+
+def host_slot(url):
+    """Семафор хоста: не больше GATTO_HOST_CONCURRENCY одновременных запросов."""
+    host = urlsplit(url).netloc
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = BoundedSemaphore(GATTO_HOST_CONCURRENCY)
+    return slot
+
+
+def endpoint_of(url):
+    """https://api.nl.gatto.pw/pet.feed -> pet.feed"""
+    return urlsplit(url).path.rsplit("/", 1)[-1]
+
+
+def gatto_post(url, payload=None):
+    gatto_limiter.acquire()
+    with host_slot(url):
+        started = time.monotonic()
         try:
-            r = gatto.post(url, headers=HEADERS, json=payload or {}, timeout=GATTO_TIMEOUT)
-            if r.status_code == 200:
-                return r
-        except:
-            pass
-        time.sleep(RETRY_DELAY)
+            r = instrumented("gatto", endpoint_of(url), lambda: gatto.post(
+                url, headers=account().headers, json=payload or {}, timeout=GATTO_TIMEOUT
+            ))
+        except Exception:
+            gatto_limiter.report(None, time.monotonic() - started)
+            raise
+    gatto_limiter.report(r.status_code, time.monotonic() - started)
+    return r
+
+
+class CircuitBreaker:
+    """Предохранитель хоста.
+
+    После threshold сбоев подряд размыкается: запросы сразу получают отказ,
+    не тратя потоки и соединения. Через cooldown пропускает один пробный
+    запрос (half-open): успех замыкает цепь, сбой снова размыкает.
+    """
+
+    def __init__(self, host, threshold, cooldown):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log(f"{self.host}: связь восстановлена, предохранитель замкнут", host=self.host)
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                if not self.probing:
+                    log(f"{self.host}: {self.failures} сбоев подряд, предохранитель разомкнут",
+                        level="warning", host=self.host)
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+_breakers = {}
+_breakers_lock = Lock()
+
+
+def host_breaker(url):
+    host = urlsplit(url).netloc
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host, BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+    return breaker
+
+
+def retry_after(r):
+    """Секунды из заголовка Retry-After (только числовая форма)."""
+    try:
+        return max(0.0, float(r.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt):
+    """Экспоненциальная задержка с полным джиттером."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def guarded_post(url, payload=None):
+    """Один запрос через предохранитель хоста.
+
+    Возвращает (ответ или None, можно ли повторить, задержка перед повтором).
+    Если сервер просит ждать дольше RETRY_AFTER_MAX, повтор не делается:
+    поток не должен спать часами.
+    """
+    breaker = host_breaker(url)
+    if not breaker.allow():
+        metrics.inc("gatto_circuit_rejections_total", (("endpoint", endpoint_of(url)),))
+        return None, False, 0
+    try:
+        r = gatto_post(url, payload)
+    except Exception:
+        # Таймаут или обрыв соединения; уже учтено в gatto_exceptions_total
+        breaker.failure()
+        return None, True, None
+    if r.status_code == 429:
+        breaker.success()
+        delay = retry_after(r)
+        if delay:
+            # Общая пауза для всех аккаунтов — не длиннее RETRY_AFTER_MAX
+            gatto_limiter.pause(min(delay, RETRY_AFTER_MAX))
+        return None, delay is None or delay <= RETRY_AFTER_MAX, delay
+    if r.status_code >= 500:
+        breaker.failure()
+        delay = retry_after(r)
+        return None, delay is None or delay <= RETRY_AFTER_MAX, delay
+    # Сервер жив: 2xx, либо 4xx, который повторять бессмысленно
+    breaker.success()
+    return r, False, None
+
+
+def safe_request(url, payload=None):
+    for attempt in range(MAX_RETRIES):
+        if attempt:
+            metrics.inc("gatto_retries_total", (("endpoint", endpoint_of(url)),))
+        r, retryable, delay = guarded_post(url, payload)
+        if r is not None:
+            return r if r.status_code == 200 else None
+        if not retryable:
+            return None
+        if attempt < MAX_RETRIES - 1:
+            traced_sleep(delay if delay is not None else backoff_delay(attempt), "backoff")
     return None
 
 
 def single_request(url, payload=None):
-    try:
-        gatto.post(url, headers=HEADERS, json=payload or {}, timeout=GATTO_TIMEOUT)
-    except:
-        pass
+    return guarded_post(url, payload)[0]
+
+
+def parse_json(r):
+    """r.json(), время разбора попадает в трассу запуска."""
+    with span("parse", endpoint_of(r.url)):
+        return r.json()
+
+
+def gatto_submit(fn, *args):
+    """Запускает любую обёртку API в общем пуле, возвращает Future.
+
+    Задача выполняется от имени текущего аккаунта и в трассе текущего запуска.
+    """
+    return gatto_executor.submit(copy_context().run, traced_call, fn, *args)
+
+
+def gatto_map(fn, items, limit=GATTO_WORKERS):
+    """Вызывает fn(item) параллельно (не больше limit одновременно).
+
+    Отдаёт пары (item, результат) по мере готовности; ошибка fn даёт None.
+    """
+    items = iter(items)
+    pending = {}
+    while True:
+        while len(pending) < limit:
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            pending[gatto_submit(fn, item)] = item
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            item = pending.pop(fut)
+            try:
+                result = fut.result()
+            except Exception as e:
+                log(f"Ошибка параллельного запроса: {e}", level="error")
+                result = None
+            yield item, result
 
 
 # ================= getAllStats Wrapper =================
 def get_all_stats():
-    return safe_request("https://api.nl.gatto.pw/pet.getAllStats")
+    r = safe_request(f"{GATTO_API}/pet.getAllStats")
+    if not r:
+        return None
+    try:
+        return parse_json(r)
+    except:
+        return None
+
+
+def get_all_stats_before_action(max_age=STATS_TTL):
+    """Прогрев перед действием: возвращает разобранный pet.getAllStats.
+
+    Ответ кешируется на max_age секунд; одновременные вызовы ждут один общий
+    запрос вместо того, чтобы слать свои. None — статистику получить не удалось.
+    """
+    cache = account().stats
+
+    def fresh():
+        return cache["data"] is not None and time.monotonic() - cache["at"] < max_age
+
+    if fresh():
+        return cache["data"]
+    with account().stats_lock:
+        # Пока ждали блокировку, статистику мог обновить другой поток
+        if fresh():
+            return cache["data"]
+        data = get_all_stats()
+        if data is not None:
+            cache["data"] = data
+            cache["at"] = time.monotonic()
+        return data
+
+
+# ================= Кормление по статистике =================
+def pet_stats_list(stats):
+    """Достаёт записи питомцев из ответа pet.getAllStats (список или словарь).
+
+    Формат ответа не проверен: ищем список под pets/stats/result, иначе
+    считаем питомцем любой вложенный словарь.
+    """
+    if isinstance(stats, list):
+        return [p for p in stats if isinstance(p, dict)]
+    if not isinstance(stats, dict):
+        return []
+    for key in ("pets", "stats", "result"):
+        if isinstance(stats.get(key), (list, dict)):
+            return pet_stats_list(stats[key])
+    pets = [v for v in stats.values() if isinstance(v, dict)]
+    return pets or [stats]
+
+
+def parse_timestamp(value):
+    """Секунды, миллисекунды или ISO-строка -> time.time()-секунды; иначе None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)) and value > 0:
+        return value / 1000 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def plan_feeding(stats):
+    """По статистике решает, кормить ли сейчас и когда питомцы проголодаются.
+
+    Возвращает (кормить_сейчас, ближайший_срок или None) или None, если в
+    ответе нет ни одного известного поля — тогда кормим по старой схеме.
+    """
+    now_ts = time.time()
+    known = False
+    hungry = False
+    next_due = None
+    for pet in pet_stats_list(stats):
+        for field in FEED_DUE_FIELDS:
+            due = parse_timestamp(pet.get(field))
+            if due is None:
+                continue
+            known = True
+            if due <= now_ts + FEED_LEAD:
+                hungry = True
+            elif next_due is None or due < next_due:
+                next_due = due
+        for field in SATIETY_FIELDS:
+            value = pet.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                known = True
+                hungry = hungry or value <= FEED_SATIETY_THRESHOLD
+    if not known:
+        return None
+    return hungry, next_due
 
 
-def get_all_stats_before_action():
-    get_all_stats()
-    time.sleep(2)
+def schedule_next_feeding(plan):
+    now_ts = time.time()
+    next_due = plan[1] if plan else None
+    at = next_due - FEED_LEAD if next_due else now_ts + FEED_FALLBACK_INTERVAL
+    account().feed_plan["next"] = min(max(at, now_ts + FEED_MIN_INTERVAL), now_ts + FEED_MAX_INTERVAL)
 
 
-# ================= API =================
 def feed_cat():
-    log("Кормление котов…")
-    get_all_stats_before_action()
-    safe_request("https://api.nl.gatto.pw/pet.feed", {"all": True})
+    """Кормит, только когда по pet.getAllStats питомцы голодны.
+
+    Планировщик дёргает задачу часто, но до запланированного срока она
+    возвращается сразу, без запросов. Если статистика не разбирается,
+    кормим каждые FEED_FALLBACK_INTERVAL секунд, как раньше.
+    """
+    if time.time() < account().feed_plan["next"]:
+        return SKIPPED
+
+    log("Кормление котов…", kind="feed_check")
+    stats = get_all_stats_before_action()
+    plan = plan_feeding(stats) if stats else None
+    feed_plan = account().feed_plan
+    if stats and plan is None and not feed_plan["fallback_warned"]:
+        feed_plan["fallback_warned"] = True
+        log(
+            f"В pet.getAllStats нет полей {', '.join(FEED_DUE_FIELDS + SATIETY_FIELDS)} — "
+            f"кормлю каждые {FEED_FALLBACK_INTERVAL} с (проверьте FEED_DUE_FIELDS/SATIETY_FIELDS)",
+            level="warning", endpoint="pet.getAllStats"
+        )
+    elif plan is not None:
+        feed_plan["fallback_warned"] = False
+    if plan is not None and not plan[0]:
+        log("Питомцы сыты — кормление не нужно", kind="feed_check")
+        schedule_next_feeding(plan)
+        return
+
+    if not safe_request(f"{GATTO_API}/pet.feed", {"all": True}):
+        log("Кормление не удалось (ошибка)", level="warning", endpoint="pet.feed")
+        account().feed_plan["next"] = time.time() + FEED_MIN_INTERVAL
+        return False
     log("Кормление завершено ✓")
 
+    # Срок следующего кормления — уже по статистике после еды
+    if plan is not None:
+        stats = get_all_stats_before_action(max_age=0)
+        plan = plan_feeding(stats) if stats else None
+    schedule_next_feeding(plan)
 
-def get_user_self():
-    r = safe_request("https://api.nl.gatto.pw/user.getSelf")
+
+# ================= Питомцы (кеш user.getSelf) =================
+def fetch_user_pets():
+    """Читает питомцев из user.getSelf. None — запрос не удался."""
+    r = safe_request(f"{GATTO_API}/user.getSelf")
     if not r:
-        return []
+        return None
     try:
-        data = r.json()
+        data = parse_json(r)
         pets = []
         for region in data.get("user", {}).get("regions", []):
             pet = region.get("pet")
@@ -109,410 +1227,639 @@ def get_user_self():
                 pets.append(pet)
         return pets
     except:
-        return []
+        return None
 
 
-def play_game():
-    log("Игры с питомцами…")
-    get_all_stats_before_action()
-    safe_request("https://api.nl.gatto.pw/pet.play", {"all": True})
+def refresh_pet_roster():
+    """Перечитывает питомцев и обновляет кеш по _id на месте."""
+    pets = fetch_user_pets()
+    if pets is None:
+        return False
+    acc = account()
+    with acc.roster_lock:
+        cached = acc.roster["pets"]
+        ids = set()
+        for pet in pets:
+            ids.add(pet["_id"])
+            if pet["_id"] in cached:
+                cached[pet["_id"]].update(pet)
+            else:
+                cached[pet["_id"]] = dict(pet)
+        for pet_id in set(cached) - ids:
+            del cached[pet_id]
+        acc.roster["at"] = time.monotonic()
+        acc.roster["valid"] = True
+    return True
+
+
+def invalidate_pet_roster():
+    """Следующее чтение питомцев пойдёт в сеть (действие могло изменить состав)."""
+    acc = account()
+    with acc.roster_lock:
+        acc.roster["valid"] = False
+
+
+def update_pet(pet_id, **fields):
+    """Точечно обновляет питомца в кеше, например level из ответа essence.activate."""
+    acc = account()
+    with acc.roster_lock:
+        pet = acc.roster["pets"].get(pet_id)
+        if pet is not None:
+            pet.update(fields)
 
-    pets = get_user_self()
-    for pet in pets:
-        single_request(
-            "https://api.nl.gatto.pw/ads.watch",
-            {"id": pet["_id"], "alias": "pet.play"}
-        )
-    log("Игры завершены ✓")
 
+def get_user_self():
+    """Снимок списка питомцев; в сеть идёт только если кеш устарел или сброшен."""
+    acc = account()
 
-# ================= Форматирование дропа =================
+    def fresh():
+        return acc.roster["valid"] and time.monotonic() - acc.roster["at"] < ROSTER_TTL
 
-VALID_CATEGORIES = [
-    "soft", "ton", "gton", "eventCurrency", "experience",
-    "resultSkins", "resultEggs", "resultEssence",
-    "resultLootBox", "resultPremium", "resultPromotionPromocodes",
-    "resultExtraItem", "resultMutagen", "resultFoods"
-]
+    if not fresh():
+        with acc.roster_refresh_lock:
+            # Пока ждали, кеш мог обновить другой поток
+            if not fresh():
+                refresh_pet_roster()
+    with acc.roster_lock:
+        return [dict(p) for p in acc.roster["pets"].values()]
 
-CATEGORY_EMOJI = {
-    "resultEggs": "🥚 Яйца",
-    "resultFoods": "🍖 Еда",
-    "resultMutagen": "🧪 Мутаген",
-    "resultSkins": "🎨 Скины",
-    "resultEssence": "✨ Эссенции",
-    "resultExtraItem": "📦 Доп. предметы",
-    "resultPremium": "💎 Премиум",
-    "resultPromotionPromocodes": "🎟 Промокоды",
-    "resultLootBox": "🎁 Боксы (дроп)"
-}
 
-def format_loot_stats(stats, total_boxes):
-    """Возвращает красивый текст Telegram с группировкой."""
-    out = []
-    out.append("📦 Финальная статистика\n-------------------------------------")
-    out.append(f"🎁 Открытые боксы: {total_boxes}")
-    out.append("-------------------------------------")
+def watch_ad(pet_id):
+    r = single_request(f"{GATTO_API}/ads.watch", {"id": pet_id, "alias": "pet.play"})
+    return r is not None and r.status_code == 200
 
-    # Валюта
-    for key in ["soft", "ton", "gton", "eventCurrency", "experience"]:
-        if key in stats and isinstance(stats[key], int):
-            out.append(f"💰 {key}: {stats[key]}")
-    out.append("-------------------------------------")
 
-    # Предметы
-    for cat, items in stats.items():
-        if isinstance(items, dict) and items:
-            title = CATEGORY_EMOJI.get(cat, f"📂 {cat}")
-            out.append(f"{title}:")
-            for name, count in items.items():
-                out.append(f"  - {name} — {count}")
-            out.append("-------------------------------------")
+def play_game():
+    log("Игры с питомцами…")
+    get_all_stats_before_action()
+    if not safe_request(f"{GATTO_API}/pet.play", {"all": True}):
+        log("Игры не удались (ошибка)", level="warning", endpoint="pet.play")
+        return False
 
-    return "\n".join(out)
+    # Реклама за игру — по питомцу, параллельно
+    pets = get_user_self()
+    failed = []
+    for pet_id, ok in gatto_map(watch_ad, [pet["_id"] for pet in pets], ADS_CONCURRENCY):
+        if not ok:
+            failed.append(pet_id)
+
+    log(f"Игры завершены ✓ Реклама: {len(pets) - len(failed)}/{len(pets)}")
+    if failed:
+        send_telegram(
+            f"⚠️ ads.watch не прошёл для {len(failed)} из {len(pets)} питомцев: {', '.join(failed)}"
+        )
 
 
-# ================= /box командный процесс =================
-def open_boxes():
-    """Открывает все боксы со склада и отправляет финальную статистику."""
-    from collections import defaultdict
-
-    send_telegram("📦 Ищу боксы…")
-
-    lootboxes_stats = {
-        "soft": 0,
-        "ton": 0,
-        "gton": 0,
-        "eventCurrency": 0,
-        "experience": 0,
-        "resultSkins": [],
-        "resultEggs": [],
-        "resultEssence": [],
-        "resultLootBox": [],
-        "resultPremium": [],
-        "resultPromotionPromocodes": [],
-        "resultExtraItem": [],
-        "resultMutagen": [],
-        "resultFoods": []
-    }
+# ================= Награды =================
+# Одна модель для дропа из боксов, pet.getPrize и ежедневного подарка:
+# ответ разбирается один раз, дальше с ним работают агрегатор, рендер и журнал.
+CURRENCIES = ["soft", "ton", "gton", "eventCurrency", "experience"]
+
+# Категория ответа -> (заголовок, иконка); порядок — порядок вывода
+REWARD_CATEGORIES = {
+    "resultSkins": ("Скины", "🎨"),
+    "resultEggs": ("Яйца", "🥚"),
+    "resultEssence": ("Эссенции", "✨"),
+    "resultMutagen": ("Мутаген", "🧪"),
+    "resultFoods": ("Еда", "🍖"),
+    "resultExtraItem": ("Доп. предметы", "📦"),
+    "resultLootBox": ("Лутбоксы", "🎁"),
+    "resultPremium": ("Премиум", "💎"),
+    "resultPromotionPromocodes": ("Промокоды", "🎟"),
+    "other": ("Прочее", "📂"),
+}
 
-    # ---- 1. Получаем боксы ----
-    r = safe_request(
-        "https://api.nl.gatto.pw/warehouseGoods.getByLimit",
-        {"type": "lootBoxes", "limit": 50, "offset": 0}
-    )
-    if not r:
-        send_telegram("❌ Ошибка: не удалось получить список боксов.")
-        return
+# itemType -> как получить ключ предмета для группировки
+ITEM_KEYS = {
+    "egg": lambda item: f"{item.get('allowedRegion')}_{item.get('rarity')}",
+    "skin": lambda item: item.get("itemName"),
+    "food": lambda item: item.get("name"),
+    "mutagen": lambda item: item.get("probability"),
+    "essence": lambda item: item.get("type"),
+    "extraItem": lambda item: item.get("name"),
+    "lootBox": lambda item: item.get("name"),
+    "premiumItem": lambda item: item.get("name"),
+    "promotionPromocode": lambda item: item.get("name"),
+}
 
-    try:
-        boxes = r.json()
-    except:
-        send_telegram("❌ Ошибка разбора JSON списка боксов.")
-        return
+# Тип ежедневного подарка -> (категория, поля с названием по порядку).
+# Подарок приходит плоским объектом со своими полями (type — это тип
+# подарка, а не эссенции), поэтому ITEM_KEYS лутбоксов к нему не подходят.
+DAILY_PRIZE_TYPES = {
+    "eggs": ("resultEggs", ("allowedRegion", "name")),
+    "skins": ("resultSkins", ("itemName", "name")),
+    "foods": ("resultFoods", ("name",)),
+    "mutagen": ("resultMutagen", ("probability", "name")),
+    "essences": ("resultEssence", ("name",)),
+    "extraItem": ("resultExtraItem", ("name",)),
+    "lootBox": ("resultLootBox", ("name",)),
+    "premium": ("resultPremium", ("name",)),
+    "promotionPromocodes": ("resultPromotionPromocodes", ("name",)),
+}
+# Подарок может прийти и с именем категории вместо типа: resultEggs и т.п.
+DAILY_PRIZE_TYPES.update({cat: (cat, fields) for cat, fields in list(DAILY_PRIZE_TYPES.values())})
+
+SEPARATOR = "-------------------------------------"
+
+
+def get_item_key(item):
+    key_of = ITEM_KEYS.get(item.get("itemType"))
+    return str(key_of(item)) if key_of else "unknown"
+
+
+class RewardItem:
+    __slots__ = ("category", "key", "count")
+
+    def __init__(self, category, key, count):
+        self.category = category
+        self.key = key
+        self.count = count
+
+
+class Reward:
+    """Разобранная награда: дельты валют и список предметов."""
+
+    __slots__ = ("currency", "items")
+
+    def __init__(self, currency, items):
+        self.currency = currency
+        self.items = items
+
+    @classmethod
+    def from_loot(cls, data):
+        """Ответ lootBox.open / pet.getPrize."""
+        currency = {cur: data[cur] for cur in CURRENCIES if data.get(cur)}
+        items = [
+            RewardItem(cat, get_item_key(item), item.get("count", 1))
+            for cat in REWARD_CATEGORIES
+            for item in data.get(cat) or []
+        ]
+        return cls(currency, items)
+
+    @classmethod
+    def from_daily_prize(cls, data):
+        """Ответ user.getDailyPrize: один предмет с type и value."""
+        prize_type = data.get("type")
+        value = data.get("value") or 0
+        if prize_type in CURRENCIES:
+            return cls({prize_type: value} if value else {}, [])
+        category, fields = DAILY_PRIZE_TYPES.get(prize_type, ("other", ()))
+        name = next((data[f] for f in fields if data.get(f)), prize_type)
+        key = f"{name} ({data['rarity']})" if data.get("rarity") else str(name)
+        return cls({}, [RewardItem(category, key, value or 1)])
+
+
+class RewardTally:
+    """Сумма наград: счётчики по валютам и (категория, ключ).
+
+    Сырые ответы не хранятся — память O(различных предметов), а не O(наград).
+    """
+
+    def __init__(self):
+        self.currency = dict.fromkeys(CURRENCIES, 0)
+        self.items = defaultdict(lambda: defaultdict(int))
+
+    def add(self, reward):
+        for cur, value in reward.currency.items():
+            self.currency[cur] += value
+        for item in reward.items:
+            self.items[item.category][item.key] += item.count
+
+    def render(self, header):
+        currency = [f"💰 {cur}: {v}" for cur, v in self.currency.items() if v]
+        items = []
+        for cat, (title, icon) in REWARD_CATEGORIES.items():
+            if self.items.get(cat):
+                items.append(f"{icon} {title}")
+                items.extend(f"• {k}: {c}" for k, c in self.items[cat].items())
+
+        lines = [header, SEPARATOR, *currency]
+        if currency and items:
+            lines.append(SEPARATOR)
+        lines.extend(items)
+        if not currency and not items:
+            lines.append("Нет наград")
+        return "\n".join(lines)
 
-    if not boxes:
-        send_telegram("📦 На складе нет боксов.")
-        return
 
-    # ---- 2. Открываем бокс за боксом ----
-    for box in boxes:
-        box_id = box.get("_id")
-        if not box_id:
-            continue
+def render_reward(reward, header):
+    tally = RewardTally()
+    tally.add(reward)
+    return tally.render(header)
 
-        resp = safe_request("https://api.nl.gatto.pw/lootBox.open", {"id": box_id})
-        if not resp:
-            continue
 
+# ================= Склад =================
+def fetch_warehouse(goods_type, page_size=WAREHOUSE_PAGE_SIZE):
+    """Постранично выгружает весь склад указанного типа. None — ошибка запроса."""
+    goods = []
+    seen = set()
+    offset = 0
+    while True:
+        r = safe_request(
+            f"{GATTO_API}/warehouseGoods.getByLimit",
+            {"type": goods_type, "limit": page_size, "offset": offset}
+        )
+        if not r:
+            return None
         try:
-            data = resp.json()
+            page = parse_json(r)
         except:
+            return None
+
+        fresh = [g for g in page if g.get("_id") not in seen]
+        seen.update(g.get("_id") for g in fresh)
+        goods.extend(fresh)
+
+        # Короткая страница — склад закончился; страница без новых id —
+        # сервер игнорирует offset, дальше листать бессмысленно
+        if len(page) < page_size or not fresh:
+            return goods
+        offset += page_size
+
+
+# ================= Инвентарь (индекс склада) =================
+# Склад каждого аккаунта держится в памяти по типу и _id. Полный проход
+# fetch_warehouse нужен только при первом чтении, после сброса и при
+# фоновой сверке; расход и добыча правят индекс на месте.
+
+# Категория награды -> тип склада, куда попадает предмет
+INVENTORY_CATEGORIES = {"resultLootBox": "lootBoxes", "resultEssence": "essences"}
+
+
+def inventory_entry(acc, goods_type):
+    """Запись индекса (вызывать под acc.inventory_lock)."""
+    entry = acc.inventory.get(goods_type)
+    if entry is None:
+        entry = acc.inventory[goods_type] = {"items": {}, "at": 0.0, "valid": False, "pending": None}
+    return entry
+
+
+def refresh_inventory(goods_type):
+    """Полный проход по складу типа (вызывать под acc.inventory_refresh_lock).
+
+    Расход и добыча, случившиеся, пока шёл проход, накладываются на его
+    результат. False — склад прочитать не удалось.
+    """
+    acc = account()
+    with acc.inventory_lock:
+        inventory_entry(acc, goods_type)["pending"] = {"consumed": set(), "gained": {}, "stale": False}
+    goods = fetch_warehouse(goods_type)
+    with acc.inventory_lock:
+        entry = inventory_entry(acc, goods_type)
+        pending, entry["pending"] = entry["pending"], None
+        if goods is None:
+            return False
+        items = {g["_id"]: g for g in goods if g.get("_id")}
+        items.update(pending["gained"])
+        for goods_id in pending["consumed"]:
+            items.pop(goods_id, None)
+        entry["items"] = items
+        entry["at"] = time.monotonic()
+        entry["valid"] = not pending["stale"]
+    return True
+
+
+def inventory(goods_type, max_age=INVENTORY_TTL):
+    """Снимок предметов типа; в сеть идёт, только если индекс устарел или
+    сброшен. None — склад прочитать не удалось."""
+    acc = account()
+
+    def fresh():
+        with acc.inventory_lock:
+            entry = inventory_entry(acc, goods_type)
+            return entry["valid"] and time.monotonic() - entry["at"] < max_age
+
+    if not fresh():
+        with acc.inventory_refresh_lock:
+            # Пока ждали, индекс мог обновить другой поток
+            if not fresh() and not refresh_inventory(goods_type):
+                return None
+    with acc.inventory_lock:
+        return [dict(g) for g in acc.inventory[goods_type]["items"].values()]
+
+
+def consume_goods(goods_type, goods_id):
+    """Предмет израсходован (бокс открыт, эссенция применена)."""
+    acc = account()
+    with acc.inventory_lock:
+        entry = inventory_entry(acc, goods_type)
+        entry["items"].pop(goods_id, None)
+        if entry["pending"] is not None:
+            entry["pending"]["consumed"].add(goods_id)
+
+
+def invalidate_inventory(goods_type):
+    """Индекс типа разошёлся со складом — следующее чтение перечитает склад."""
+    acc = account()
+    with acc.inventory_lock:
+        entry = inventory_entry(acc, goods_type)
+        entry["valid"] = False
+        if entry["pending"] is not None:
+            entry["pending"]["stale"] = True
+
+
+def note_gained_goods(data):
+    """Добыча из lootBox.open / pet.getPrize: предметы с _id сразу попадают
+    в индекс, без _id — тип перечитается при следующем чтении."""
+    acc = account()
+    with acc.inventory_lock:
+        for category, goods_type in INVENTORY_CATEGORIES.items():
+            items = data.get(category) or []
+            if not items:
+                continue
+            entry = inventory_entry(acc, goods_type)
+            pending = entry["pending"]
+            for item in items:
+                if item.get("_id"):
+                    entry["items"][item["_id"]] = dict(item)
+                    if pending is not None:
+                        pending["gained"][item["_id"]] = dict(item)
+                else:
+                    entry["valid"] = False
+                    if pending is not None:
+                        pending["stale"] = True
+
+
+def reconcile_inventory():
+    """Фоновая сверка индекса со складом по всем типам."""
+    acc = account()
+    failed = []
+    for goods_type in INVENTORY_TYPES:
+        with acc.inventory_refresh_lock:
+            if not refresh_inventory(goods_type):
+                failed.append(goods_type)
+    if failed:
+        log(f"Сверка склада не удалась: {', '.join(failed)}", level="warning", endpoint="warehouseGoods.getByLimit")
+        return False
+
+
+def goods_label(item):
+    return str(item.get("name") or item.get("type") or item.get("itemName") or "?")
+
+
+def format_inventory():
+    """Счётчики по индексу без похода на склад; тип, которого ещё нет в
+    индексе, читается один раз."""
+    acc = account()
+    lines = ["🗃 Склад", SEPARATOR]
+    for goods_type in INVENTORY_TYPES:
+        with acc.inventory_lock:
+            entry = inventory_entry(acc, goods_type)
+            loaded = entry["at"] > 0
+        goods = inventory(goods_type, max_age=float("inf")) if loaded else inventory(goods_type)
+        if goods is None:
+            lines.append(f"{goods_type}: не удалось прочитать склад")
             continue
+        with acc.inventory_lock:
+            age = int((time.monotonic() - acc.inventory[goods_type]["at"]) / 60)
+        lines.append(f"{goods_type}: {len(goods)} (обновлено {age} мин назад)")
+        for label, n in Counter(goods_label(g) for g in goods).most_common():
+            lines.append(f"• {label}: {n}")
+    return "\n".join(lines)
 
-        # Валюта
-        for cur in ["soft", "ton", "gton", "eventCurrency", "experience"]:
-            lootboxes_stats[cur] += data.get(cur, 0)
-
-        # Категории
-        for arr in [
-            "resultSkins", "resultEggs", "resultEssence", "resultLootBox",
-            "resultPremium", "resultPromotionPromocodes",
-            "resultExtraItem", "resultMutagen", "resultFoods"
-        ]:
-            lootboxes_stats[arr].extend(data.get(arr, []))
-
-        time.sleep(0.4)
-
-    # ================= ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =================
-    def get_item_key(item):
-        if item.get("itemType") == "egg":
-            return f"{item.get('allowedRegion')}_{item.get('rarity')}"
-        if item.get("itemType") == "skin":
-            return item.get("itemName")
-        if item.get("itemType") == "food":
-            return item.get("name")
-        if item.get("itemType") == "mutagen":
-            return item.get("probability")
-        if item.get("itemType") == "essence":
-            return item.get("type")
-        if item.get("itemType") == "extraItem":
-            return item.get("name")
-        if item.get("itemType") == "lootBox":
-            return item.get("name")
-        if item.get("itemType") == "premiumItem":
-            return item.get("name")
-        if item.get("itemType") == "promotionPromocode":
-            return item.get("name")
-        return "unknown"
-
-    def format_category(items, title, icon):
-        if not items:
-            return ""
-        counts = defaultdict(int)
-        for item in items:
-            key = get_item_key(item)
-            counts[key] += item.get("count", 1)
-        lines = [f"{icon} {title}"]
-        for k, c in counts.items():
-            lines.append(f"• {k}: {c}")
-        return "\n".join(lines)
 
-    # ================= ФОРМИРОВАНИЕ ФИНАЛЬНОГО ТЕКСТА =================
-    categories = [
-        format_category(lootboxes_stats["resultSkins"], "Скины", "🎨"),
-        format_category(lootboxes_stats["resultEggs"], "Яйца", "🥚"),
-        format_category(lootboxes_stats["resultEssence"], "Эссенции", "✨"),
-        format_category(lootboxes_stats["resultMutagen"], "Мутеген", "🧪"),
-        format_category(lootboxes_stats["resultFoods"], "Еда", "🍖"),
-        format_category(lootboxes_stats["resultExtraItem"], "Доп. предметы", "📦"),
-        format_category(lootboxes_stats["resultLootBox"], "Лутбоксы", "🎁"),
-        format_category(lootboxes_stats["resultPremium"], "Премиум", "💎"),
-        format_category(lootboxes_stats["resultPromotionPromocodes"], "Промокоды", "🎟")
-    ]
+def send_inventory():
+    send_telegram(format_inventory())
 
-    # Убираем пустые категории
-    categories = [c for c in categories if c.strip()]
-
-    text_parts = [
-        "📦 Финальная статистика",
-        "-------------------------------------",
-        f"🎁 Открыто боксов: {len(boxes)}",
-        "-------------------------------------",
-        f"💰 soft: {lootboxes_stats['soft']}",
-        f"💰 ton: {lootboxes_stats['ton']}",
-        f"💰 gton: {lootboxes_stats['gton']}",
-        f"💰 eventCurrency: {lootboxes_stats['eventCurrency']}",
-        f"💰 experience: {lootboxes_stats['experience']}",
-        "-------------------------------------",
-    ]
 
-    # Добавляем категории
-    text_parts.extend(categories)
-
-    final_text = "\n".join(text_parts)
+# ================= /box командный процесс =================
+def open_box(box_id):
+    r = safe_request(f"{GATTO_API}/lootBox.open", {"id": box_id})
+    if not r:
+        # Бокса уже может не быть — при следующем чтении склад перечитается
+        invalidate_inventory("lootBoxes")
+        return None
+    consume_goods("lootBoxes", box_id)
+    try:
+        data = parse_json(r)
+    except:
+        return None
+    note_gained_goods(data)
+    return data
+
+
+class ProgressMessage:
+    """Одно сообщение в Telegram, которое обновляется не чаще раза в interval секунд."""
+
+    def __init__(self, text, interval=BOX_PROGRESS_INTERVAL):
+        self.interval = interval
+        self.account = account()
+        self.chat_id = self.account.chat_id
+        self.text = self.account.tag(text)
+        self.edited_at = time.monotonic()
+        result = tg_call("sendMessage", {"chat_id": self.chat_id, "text": self.text})
+        self.message_id = result.get("message_id") if result else None
+
+    def due(self):
+        return time.monotonic() - self.edited_at >= self.interval
+
+    def update(self, text, force=False):
+        if not force and not self.due():
+            return
+        parts = split_message(self.account.tag(text))
+        if self.message_id is None:
+            # Исходное сообщение не ушло — промежуточные обновления не шлём,
+            # только итог
+            if force:
+                send_telegram(text)
+            return
+        if parts[0] != self.text:
+            tg_call("editMessageText", {"chat_id": self.chat_id, "message_id": self.message_id, "text": parts[0]})
+            self.text = parts[0]
+        self.edited_at = time.monotonic()
+        for part in parts[1:]:
+            send_telegram(part, self.chat_id)
 
-    send_telegram(final_text)
 
-# ================= Daily Prize =================
+def open_boxes():
+    """Открывает все боксы со склада; итог копится по мере ответов и
+    показывается в одном сообщении, которое обновляется по ходу."""
+    progress = ProgressMessage("📦 Ищу боксы…")
+    tally = RewardTally()
+
+    # ---- Проходы: выгружаем склад и открываем новые боксы ----
+    # Первый проход всегда читает склад целиком: боксы могли появиться в
+    # обход бота, а пропускать их нельзя. Следующие проходы берут индекс —
+    # он перечитывает склад, только если выпавшие боксы пришли без _id.
+    seen = set()
+    opened = 0
+
+    def open_unless_cancelled(box_id):
+        # После /cancel новые запросы не уходят, дожидаемся только начатых
+        return None if cancelled() else open_box(box_id)
+
+    for n in range(BOX_MAX_PASSES):
+        if cancelled():
+            break
+        boxes = inventory("lootBoxes", max_age=0 if n == 0 else INVENTORY_TTL)
+        if boxes is None:
+            if not seen:
+                progress.update("❌ Ошибка: не удалось получить список боксов.", force=True)
+                return
+            break
+
+        box_ids = [b["_id"] for b in boxes if b.get("_id") and b["_id"] not in seen]
+        if not box_ids:
+            break
+        seen.update(box_ids)
+        set_progress(f"открыто боксов: {opened} из {len(seen)}")
+
+        for box_id, data in gatto_map(open_unless_cancelled, box_ids, BOX_OPEN_CONCURRENCY):
+            if not data:
+                continue
+            opened += 1
+            reward = Reward.from_loot(data)
+            record_reward("box", reward)
+            tally.add(reward)
+            set_progress(f"открыто боксов: {opened} из {len(seen)}")
+            if progress.due():
+                progress.update(tally.render(f"⏳ Открыто боксов: {opened} из {len(seen)}"))
+
+    if not seen and not cancelled():
+        progress.update("📦 На складе нет боксов.", force=True)
+        return
 
-def format_daily_prize(data):
-    """Форматирует ответ от getDailyPrize для отправки в Telegram."""
-    if not data:
-        return "❌ Не удалось получить ежедневный подарок"
-    
-    prize_type = data.get("type", "unknown")
-    rarity = data.get("rarity", "")
-    value = data.get("value", 0)
-    photo_url = data.get("photoUrl", "")
-    allowed_region = data.get("allowedRegion", "")
-    name = data.get("name", "")
-    item_name = data.get("itemName", "")
-    probability = data.get("probability", "")
-    
-    # Эмодзи для типов (соответствует категориям из лутбоксов)
-    type_emoji = {
-        "essences": "✨",
-        "resultEssence": "✨",
-        "eggs": "🥚",
-        "resultEggs": "🥚",
-        "skins": "🎨",
-        "resultSkins": "🎨",
-        "mutagen": "🧪",
-        "resultMutagen": "🧪",
-        "foods": "🍖",
-        "resultFoods": "🍖",
-        "extraItem": "📦",
-        "resultExtraItem": "📦",
-        "lootBox": "🎁",
-        "resultLootBox": "🎁",
-        "premium": "💎",
-        "resultPremium": "💎",
-        "promotionPromocodes": "🎟",
-        "resultPromotionPromocodes": "🎟",
-        "soft": "💰",
-        "ton": "💎",
-        "gton": "💎",
-        "experience": "⭐",
-        "eventCurrency": "🎫"
-    }
-    
-    emoji = type_emoji.get(prize_type, "🎁")
-    
-    # Формируем сообщение
-    lines = [
-        f"{emoji} Ежедневный подарок получен!",
-        "-------------------------------------",
-    ]
-    
-    # Обработка разных типов подарков
-    if prize_type in ["eggs", "resultEggs"]:
-        if allowed_region:
-            lines.append(f"Яйцо: {allowed_region}")
-        else:
-            lines.append(f"Тип: {prize_type}")
-        if rarity:
-            lines.append(f"Редкость: {rarity}")
-    elif prize_type in ["skins", "resultSkins"]:
-        if item_name:
-            lines.append(f"Скин: {item_name}")
-        elif name:
-            lines.append(f"Скин: {name}")
-        else:
-            lines.append(f"Тип: {prize_type}")
-        if rarity:
-            lines.append(f"Редкость: {rarity}")
-    elif prize_type in ["foods", "resultFoods"]:
-        if name:
-            lines.append(f"Еда: {name}")
-        else:
-            lines.append(f"Тип: {prize_type}")
-    elif prize_type in ["mutagen", "resultMutagen"]:
-        if probability:
-            lines.append(f"Мутаген: {probability}")
-        elif name:
-            lines.append(f"Мутаген: {name}")
-        else:
-            lines.append(f"Тип: {prize_type}")
-    elif prize_type in ["essences", "resultEssence"]:
-        if name:
-            lines.append(f"Эссенция: {name}")
-        else:
-            lines.append(f"Тип: {prize_type}")
-        if rarity:
-            lines.append(f"Редкость: {rarity}")
-    elif prize_type in ["extraItem", "resultExtraItem", "lootBox", "resultLootBox", 
-                         "premium", "resultPremium", "promotionPromocodes", "resultPromotionPromocodes"]:
-        if name:
-            lines.append(f"{prize_type}: {name}")
-        else:
-            lines.append(f"Тип: {prize_type}")
-        if rarity:
-            lines.append(f"Редкость: {rarity}")
-    else:
-        # Для валюты и других типов
-        lines.append(f"Тип: {prize_type}")
-        if rarity:
-            lines.append(f"Редкость: {rarity}")
-    
-    if value:
-        lines.append(f"Количество: {value}")
-    
-    return "\n".join(lines)
+    title = "⛔ Открытие боксов отменено" if cancelled() else "📦 Финальная статистика"
+    progress.update(
+        tally.render(f"{title}\n{SEPARATOR}\n🎁 Открыто боксов: {opened} из {len(seen)}"),
+        force=True
+    )
 
+# ================= Daily Prize =================
 
 def get_daily_prize():
     """Получает ежедневный подарок через user.getDailyPrize."""
     log("Получение ежедневного подарка…")
     get_all_stats_before_action()
     
-    r = safe_request("https://api.nl.gatto.pw/user.getDailyPrize", {})
+    r = safe_request(f"{GATTO_API}/user.getDailyPrize", {})
     
     if not r:
         send_telegram("❌ Ошибка: не удалось получить ежедневный подарок.")
-        log("Ежедневный подарок не получен (ошибка)")
-        return
+        log("Ежедневный подарок не получен (ошибка)", level="warning", endpoint="user.getDailyPrize")
+        return False
     
     try:
-        data = r.json()
-        msg = format_daily_prize(data)
-        send_telegram(msg)
+        reward = Reward.from_daily_prize(parse_json(r))
+        for item in reward.items:
+            if item.category in INVENTORY_CATEGORIES:
+                invalidate_inventory(INVENTORY_CATEGORIES[item.category])
+        send_telegram(render_reward(reward, "🎁 Ежедневный подарок получен!"))
+        record_reward("daily", reward)
         log("Ежедневный подарок получен ✓")
     except Exception as e:
         send_telegram(f"❌ Ошибка при разборе ежедневного подарка: {e}")
-        log(f"Ошибка при разборе ежедневного подарка: {e}")
+        log(f"Ошибка при разборе ежедневного подарка: {e}", level="error", endpoint="user.getDailyPrize")
 
 
 # ================= getPrize и Essences =================
 
-def format_prizes(data):
-    lines = []
-
-    for f in ["soft", "ton", "gton", "eventCurrency", "experience"]:
-        if data.get(f):
-            lines.append(f"{f}: {data[f]}")
-
-    for s in data.get("resultSkins", []):
-        lines.append(f"Skin: {s.get('name')} ({s.get('rarity')})")
-
-    for e in data.get("resultEggs", []):
-        lines.append(f"Egg: {e.get('allowedRegion')} ({e.get('rarity')})")
-
-    for ess in data.get("resultEssence", []):
-        lines.append(f"Essence: {ess.get('type')}")
-
-    return "\n".join(lines) if lines else "Нет призов"
-
-
 def get_prize():
     log("Получение призов…")
     get_all_stats_before_action()
-    r = safe_request("https://api.nl.gatto.pw/pet.getPrize", {"all": True})
+    r = safe_request(f"{GATTO_API}/pet.getPrize", {"all": True})
     if not r:
         send_telegram("Призы не получены (ошибка).")
-        return
+        return False
 
     try:
-        msg = format_prizes(r.json())
-        send_telegram(f"🎁 Призы:\n{msg}")
+        data = parse_json(r)
+        note_gained_goods(data)
+        reward = Reward.from_loot(data)
+        send_telegram(render_reward(reward, "🎁 Призы"))
+        record_reward("prize", reward)
     except:
         send_telegram("Ошибка при разборе призов.")
 
     log("Призы получены ✓")
 
 
-# ===== Эссенции (без изменений) =====
+# ===== Эссенции =====
 
 def get_pets_not_level_10():
     pets = get_user_self()
-    return [{"id": p["_id"], "level": p.get("level", 0)} for p in pets if p.get("level", 0) < 10]
-
-
-def get_first_essence():
-    r = safe_request(
-        "https://api.nl.gatto.pw/warehouseGoods.getByLimit",
-        {"type": "essences", "limit": 8, "offset": 0}
-    )
-    if not r:
-        return None
-    try:
-        arr = r.json()
-        return arr[0] if arr else None
-    except:
-        return None
+    return [
+        {"id": p["_id"], "level": p.get("level", 0)}
+        for p in pets if p.get("level", 0) < MAX_PET_LEVEL
+    ]
 
 
 def use_essence(pet_id, essence_id):
     r = safe_request(
-        "https://api.nl.gatto.pw/essence.activate",
+        f"{GATTO_API}/essence.activate",
         {"petId": pet_id, "essenceId": essence_id}
     )
     if not r:
+        # Питомец мог исчезнуть или уже прокачаться, эссенция — кончиться:
+        # пусть кеши перечитаются
+        invalidate_pet_roster()
+        invalidate_inventory("essences")
         return None
+    consume_goods("essences", essence_id)
     try:
-        return r.json()
+        res = parse_json(r)
     except:
         return None
+    if "level" in res:
+        update_pet(pet_id, level=res["level"])
+    return res
+
+
+def plan_essences(pets, essences):
+    """Раскладывает эссенции по питомцам заранее.
+
+    Первыми получают те, кому до MAX_PET_LEVEL ближе всего; каждому выдаётся
+    по эссенции на недостающий уровень. Остаток идёт в общий резерв.
+    """
+    pool = deque(essences)
+    plan = {}
+    for pet in sorted(pets, key=lambda p: -p["level"]):
+        need = MAX_PET_LEVEL - pet["level"]
+        plan[pet["id"]] = deque(pool.popleft() for _ in range(min(need, len(pool))))
+    return plan, pool
+
+
+def level_up_pet(pet, own, spare, spare_lock):
+    """Применяет эссенции к одному питомцу: сначала свои, потом из резерва.
+
+    Эссенция, которую не удалось применить (уже израсходована или
+    недействительна), выбрасывается, а не передаётся следующему питомцу.
+    Питомец выбывает после ESSENCE_MAX_FAILURES неудач подряд — тогда дело,
+    скорее всего, в нём самом.
+
+    Возвращает (применено, новый уровень, выбыл ли питомец). Неиспользованные
+    эссенции возвращаются в резерв для остальных питомцев.
+    """
+    applied = 0
+    level = pet["level"]
+    failures = 0
+    failed = False
+
+    while level < MAX_PET_LEVEL and not cancelled():
+        if own:
+            ess = own.popleft()
+        else:
+            with spare_lock:
+                ess = spare.popleft() if spare else None
+        if ess is None:
+            break
+
+        res = use_essence(pet["id"], ess["_id"])
+        if not res:
+            failures += 1
+            if failures >= ESSENCE_MAX_FAILURES:
+                failed = True
+                break
+            continue
+
+        failures = 0
+        applied += 1
+        level = res.get("level", level)
+
+    with spare_lock:
+        spare.extend(own)
+    own.clear()
+    return applied, level, failed
 
 
 def apply_essences_to_pets():
@@ -523,121 +1870,887 @@ def apply_essences_to_pets():
         send_telegram("Нет питомцев ниже 10 уровня.")
         return
 
+    # ---- Весь запас эссенций: явная команда перечитывает склад ----
+    essences = inventory("essences", max_age=0)
+    if essences is None:
+        send_telegram("❌ Ошибка: не удалось получить список эссенций.")
+        return
+    if not essences:
+        send_telegram("Эссенции закончились. Всего применено: 0")
+        return
+
+    plan, spare = plan_essences(pets, essences)
+    set_progress(f"питомцев ниже {MAX_PET_LEVEL} уровня: {len(pets)}, эссенций: {len(essences)}")
+    spare_lock = Lock()
 
     applied = 0
     improved_pets = 0
+    active = {pet["id"]: pet for pet in pets}
+
+    # ---- Питомцы качаются параллельно; повторный раунд забирает эссенции,
+    # которые вернули в резерв уже прокачанные питомцы ----
+    while active:
+        jobs = [(pet, plan.get(pet["id"]) or deque()) for pet in active.values()]
+        progress = False
+        for (pet, _), result in gatto_map(
+            lambda job: level_up_pet(job[0], job[1], spare, spare_lock),
+            jobs, ESSENCE_CONCURRENCY
+        ):
+            if result is None:
+                del active[pet["id"]]
+                continue
+            done, level, failed = result
+            applied += done
+            progress = progress or done > 0
+            pet["level"] = level
+            if level >= MAX_PET_LEVEL:
+                improved_pets += 1
+            if level >= MAX_PET_LEVEL or failed:
+                del active[pet["id"]]
+            set_progress(f"применено эссенций: {applied}, улучшено питомцев: {improved_pets}")
+        plan = {}
+        if not spare or not progress or cancelled():
+            break
 
-    for pet in pets:
-        pet_id = pet["id"]
-        current_level = pet["level"]
+    if active and not spare and not cancelled():
+        send_telegram(f"Эссенции закончились. Всего применено: {applied}")
 
-        while True:
-            ess = get_first_essence()
-            if not ess:
-                send_telegram(f"Эссенции закончились. Всего применено: {applied}")
-                return
+    send_telegram(
+        f"{'⛔ Прокачка отменена' if cancelled() else '✨ Прокачка завершена'}.\n"
+        f"Применено эссенций: {applied}\n"
+        f"Питомцев улучшено: {improved_pets}"
+    )
 
-            res = use_essence(pet_id, ess["_id"])
-            if not res:
-                break
 
-            applied += 1
-            new_level = res.get("level", current_level)
+# ================= Состояние (SQLite) =================
+_db = None
+_db_lock = Lock()
+
+DB_SCHEMA = """
+-- Принятые update_id вебхука: общие для всех воркеров gunicorn
+CREATE TABLE IF NOT EXISTS seen_updates (
+    update_id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL
+);
+
+-- Идущие /box и /essence: одна строка на (аккаунт, команду) на все воркеры
+CREATE TABLE IF NOT EXISTS command_runs (
+    account TEXT NOT NULL,
+    command TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    started REAL NOT NULL,
+    heartbeat REAL NOT NULL,
+    progress TEXT NOT NULL,
+    cancel INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (account, command)
+);
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    job TEXT PRIMARY KEY,
+    last_run REAL NOT NULL,
+    last_success REAL,
+    last_outcome TEXT NOT NULL
+);
+
+-- Журнал наград: одно событие на ответ (бокс, приз, подарок) с валютой
+-- и по строке на каждый тип предмета в нём
+CREATE TABLE IF NOT EXISTS reward_events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    account TEXT NOT NULL DEFAULT 'default',
+    source TEXT NOT NULL,
+    soft NUMERIC NOT NULL DEFAULT 0,
+    ton NUMERIC NOT NULL DEFAULT 0,
+    gton NUMERIC NOT NULL DEFAULT 0,
+    event_currency NUMERIC NOT NULL DEFAULT 0,
+    experience NUMERIC NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS reward_events_ts ON reward_events (ts, source);
+
+CREATE TABLE IF NOT EXISTS reward_items (
+    event_id INTEGER NOT NULL REFERENCES reward_events (id),
+    ts REAL NOT NULL,
+    account TEXT NOT NULL DEFAULT 'default',
+    category TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reward_items_ts ON reward_items (ts, category);
+CREATE INDEX IF NOT EXISTS reward_items_category ON reward_items (category, ts);
+"""
+
+# Колонки, добавленные после первых версий схемы: (таблица, колонка, определение)
+DB_COLUMNS = [
+    ("reward_events", "account", "TEXT NOT NULL DEFAULT 'default'"),
+    ("reward_items", "account", "TEXT NOT NULL DEFAULT 'default'"),
+]
 
-            if new_level >= 10:
-                improved_pets += 1
-                break
+DB_INDEXES = """
+CREATE INDEX IF NOT EXISTS reward_events_account ON reward_events (account, ts);
+CREATE INDEX IF NOT EXISTS reward_items_account ON reward_items (account, ts);
+"""
+
+
+def db():
+    """Общее соединение с STATE_DB (autocommit, WAL — читают и пишут несколько процессов)."""
+    global _db
+    with _db_lock:
+        if _db is None:
+            conn = sqlite3.connect(STATE_DB, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(DB_SCHEMA)
+            for table, column, definition in DB_COLUMNS:
+                columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            conn.executescript(DB_INDEXES)
+            _db = conn
+    return _db
+
+
+def db_execute(sql, params=()):
+    conn = db()
+    with _db_lock:
+        return conn.execute(sql, params).fetchall()
+
+
+def record_job_run(name, ok, outcome):
+    t = time.time()
+    try:
+        db_execute(
+            "INSERT INTO job_runs (job, last_run, last_success, last_outcome) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(job) DO UPDATE SET last_run = excluded.last_run, "
+            "last_success = COALESCE(excluded.last_success, job_runs.last_success), "
+            "last_outcome = excluded.last_outcome",
+            (name, t, t if ok else None, outcome)
+        )
+    except sqlite3.Error as e:
+        log(f"Не удалось сохранить состояние {name}: {e}", level="error")
 
-            current_level = new_level
 
-    send_telegram(
-        f"✨ Прокачка завершена.\n"
-        f"Применено эссенций: {applied}\n"
-        f"Питомцев улучшено: {improved_pets}"
+def last_success(name):
+    try:
+        rows = db_execute("SELECT last_success FROM job_runs WHERE job = ?", (name,))
+    except sqlite3.Error as e:
+        log(f"Не удалось прочитать состояние {name}: {e}", level="error")
+        return None
+    return rows[0][0] if rows else None
+
+
+# ================= Журнал наград =================
+STATS_PERIOD_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def record_reward(source, reward):
+    """Пишет одну награду в журнал. Ошибки БД не мешают самой команде."""
+    t = time.time()
+    name = account().name
+    counts = defaultdict(int)
+    for item in reward.items:
+        counts[(item.category, item.key)] += item.count
+    try:
+        conn = db()
+        with _db_lock:
+            conn.execute("BEGIN")
+            try:
+                event_id = conn.execute(
+                    "INSERT INTO reward_events (ts, account, source, soft, ton, gton, event_currency, experience) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (t, name, source, *(reward.currency.get(c, 0) for c in CURRENCIES))
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO reward_items (event_id, ts, account, category, item_key, count) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(event_id, t, name, cat, key, n) for (cat, key), n in counts.items()]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    except sqlite3.Error as e:
+        log(f"Не удалось записать награду в журнал: {e}", level="error")
+
+
+def parse_stats_period(arg):
+    """'24h', '7d', '2w' -> секунды; 'all' -> None. Без аргумента — сутки."""
+    arg = (arg or "24h").strip().lower()
+    if arg == "all":
+        return None
+    m = re.fullmatch(r"(\d+)([hdw])", arg)
+    if not m:
+        raise ValueError(arg)
+    return int(m.group(1)) * STATS_PERIOD_UNITS[m.group(2)]
+
+
+def format_reward_stats(arg):
+    try:
+        period = parse_stats_period(arg)
+    except ValueError:
+        return "Формат: /stats [24h | 7d | 2w | all]"
+    since = time.time() - period if period else 0
+    name = account().name
+
+    events = db_execute(
+        "SELECT source, COUNT(*), SUM(soft), SUM(ton), SUM(gton), SUM(event_currency), SUM(experience) "
+        "FROM reward_events WHERE account = ? AND ts >= ? GROUP BY source ORDER BY source",
+        (name, since)
+    )
+    if not events:
+        return f"📊 За период {arg or '24h'} наград нет."
+    items = db_execute(
+        "SELECT category, item_key, SUM(count) FROM reward_items WHERE account = ? AND ts >= ? "
+        "GROUP BY category, item_key ORDER BY category, SUM(count) DESC",
+        (name, since)
     )
 
+    source_names = {"box": "Боксы", "prize": "Призы", "daily": "Ежедневные подарки"}
+    totals = [0] * len(CURRENCIES)
+    lines = [f"📊 Статистика за {arg or '24h'}", SEPARATOR]
+    for source, n, *sums in events:
+        lines.append(f"{source_names.get(source, source)}: {n}")
+        totals = [a + (b or 0) for a, b in zip(totals, sums)]
+    lines.append(SEPARATOR)
+    for cur, total in zip(CURRENCIES, totals):
+        if total:
+            lines.append(f"💰 {cur}: {total}")
+
+    current = None
+    for category, key, n in items:
+        if category != current:
+            current = category
+            title, icon = REWARD_CATEGORIES.get(category, (category, "📂"))
+            lines.append(f"{icon} {title}")
+        lines.append(f"• {key}: {n}")
+    return "\n".join(lines)
+
+
+def send_reward_stats(arg):
+    send_telegram(format_reward_stats(arg))
+
 
 # ================= Scheduler =================
+# Фиксированный пул под плановые задачи: сколько бы ни тормозил Gatto,
+# потоков и одновременных задач не станет больше SCHEDULER_WORKERS. Аккаунтов
+# бывает больше — тогда по потоку на аккаунт. Каждому аккаунту достаётся не
+# больше ACCOUNT_JOB_SLOTS потоков, остальные его задачи ждут в его же
+# очереди: зависший аккаунт не занимает пул, и задачи других идут сразу.
+job_executor = ThreadPoolExecutor(
+    max_workers=max(SCHEDULER_WORKERS, len(ACCOUNTS)), thread_name_prefix="job"
+)
+ACCOUNT_JOB_SLOTS = max(1, SCHEDULER_WORKERS // len(ACCOUNTS))
+_running_jobs = set()
+_running_lock = Lock()
+
+
+SKIPPED = "skipped"
+
+
+def run_job(fn, acc):
+    """Ставит задачу аккаунта в пул. Если она ещё не закончилась с прошлого
+    раза или аккаунт на паузе — запуск пропускается. Если все ACCOUNT_JOB_SLOTS
+    аккаунта заняты, задача ждёт в его очереди и уходит в пул, когда
+    освободится место. Возвращает Future (None — пропущена или ждёт)."""
+    name = acc.job_key(fn.__name__)
+    lag = scheduler_lag(fn, acc)
+    if lag is not None:
+        note_job_lag(name, lag)
+    if acc.paused():
+        return None
+    with _running_lock:
+        if name in _running_jobs:
+            log(f"{fn.__name__} ещё выполняется — запуск пропущен", kind="job_overlap", account=acc.name)
+            return None
+        _running_jobs.add(name)
+    dispatched = time.monotonic()
+
+    def wrapper():
+        trace = start_trace(name, "job", lag, time.monotonic() - dispatched)
+        token = current_trace.set(trace)
+        outcome = SKIPPED
+        try:
+            # Задача сообщает о неудаче, возвращая False; SKIPPED — ей было
+            # рано, такой запуск в состояние не пишется
+            result = traced_call(fn)
+            if result is not SKIPPED:
+                ok = result is not False
+                outcome = "ok" if ok else "failed"
+                record_job_run(name, ok, outcome)
+                note_account_outcome(ok)
+        except Exception as e:
+            outcome = f"error: {e}"
+            log(f"Ошибка в задаче {fn.__name__}: {e}", level="error")
+            record_job_run(name, False, outcome)
+            note_account_outcome(False)
+        finally:
+            current_trace.reset(token)
+            finish_trace(trace, outcome, keep=outcome is not SKIPPED)
+            with _running_lock:
+                _running_jobs.discard(name)
+                following = acc.pending_jobs.popleft() if acc.pending_jobs else None
+                if following is None:
+                    acc.jobs_in_flight -= 1
+            if following is not None:
+                job_executor.submit(in_account, acc, following)
+
+    with _running_lock:
+        if acc.jobs_in_flight >= ACCOUNT_JOB_SLOTS:
+            acc.pending_jobs.append(wrapper)
+            return None
+        acc.jobs_in_flight += 1
+    return job_executor.submit(in_account, acc, wrapper)
+
+
+def scheduler_lag(fn, acc):
+    """На сколько секунд запуск опоздал к расписанию. run_pending вызывает
+    задачу до того, как пересчитает её next_run, так что он ещё прежний."""
+    for job in schedule.jobs:
+        if job.job_func.args == (fn, acc) and job.next_run:
+            return max(0.0, (datetime.now() - job.next_run).total_seconds())
+    return None
+
+
+def note_account_outcome(ok):
+    """Сбои одного аккаунта (отозванный токен, бан) не должны съедать общий
+    лимит запросов: после ACCOUNT_FAILURE_LIMIT неудач подряд его задачи
+    пропускаются ACCOUNT_PAUSE секунд."""
+    acc = account()
+    if acc.job_done(ok):
+        log(f"{ACCOUNT_FAILURE_LIMIT} неудачных задач подряд — пауза {ACCOUNT_PAUSE:g} с", level="warning")
+        send_telegram(f"⚠️ Задачи аккаунта не выполняются, пауза на {ACCOUNT_PAUSE / 60:g} мин.")
+
+
+def every_seconds(interval, fn, acc):
+    """Периодическая задача со случайным сдвигом до SCHEDULE_JITTER секунд."""
+    return schedule.every(interval).to(interval + SCHEDULE_JITTER).seconds.do(run_job, fn, acc)
+
+
+def job_name(job):
+    fn, acc = job.job_func.args
+    return acc.job_key(fn.__name__)
+
+
+def note_missed_runs():
+    """Пропущенные запуски (процесс спал, часы прыгнули) не догоняются:
+    run_pending выполнит просроченную задачу один раз и отсчитает период заново."""
+    now_dt = datetime.now()
+    for job in schedule.jobs:
+        period = timedelta(**{job.unit: job.interval})
+        if job.next_run and now_dt - job.next_run > period:
+            missed = int((now_dt - job.next_run) / period)
+            log(f"{job_name(job)}: пропущено запусков {missed}, выполню один раз")
+
+
+def resume_schedule(interval_jobs, daily_job, offset=0.0):
+    """Первые запуски после рестарта — по сохранённому времени последнего успеха.
+
+    Задача, чей срок ещё не подошёл, ждёт его (дальше идёт прежней сеткой),
+    а просроченные запускаются через offset секунд с интервалом INITIAL_STAGGER.
+    """
+    now_dt = datetime.now()
+    due = []
+    for job, interval in interval_jobs:
+        last = last_success(job_name(job))
+        if last is None or last + interval <= time.time():
+            due.append(job)
+        else:
+            job.next_run = datetime.fromtimestamp(last + interval)
+
+    # Ежедневный подарок положен, если с последнего срока его ещё не забирали
+    boundary = datetime.combine(now_dt.date(), daily_job.at_time)
+    if boundary > now_dt:
+        boundary -= timedelta(days=1)
+    last = last_success(job_name(daily_job))
+    if last is None or datetime.fromtimestamp(last) < boundary:
+        due.append(daily_job)
+
+    for i, job in enumerate(due):
+        job.next_run = now_dt + timedelta(seconds=offset + i * INITIAL_STAGGER)
+    log(f"Стартовый цикл: сразу {', '.join(job_name(j) for j in due) or 'ничего'}")
+
+
+def schedule_account(acc, index):
+    """Задачи одного аккаунта. Аккаунты сдвинуты друг от друга на
+    ACCOUNT_STAGGER секунд, чтобы их запросы не приходили пачкой."""
+    offset = index * ACCOUNT_STAGGER
+    interval_jobs = [
+        (every_seconds(interval, fn, acc), interval)
+        for fn, interval in (
+            (feed_cat, FEED_CHECK_INTERVAL), (get_prize, 29 * 60), (play_game, 60 * 60),
+            (reconcile_inventory, INVENTORY_RECONCILE),
+        )
+    ]
+    daily_at = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=2, seconds=offset)
+    daily_job = schedule.every().day.at(daily_at.strftime("%H:%M:%S")).do(run_job, get_daily_prize, acc)
+    in_account(acc, resume_schedule, interval_jobs, daily_job, offset)
+
+
 def scheduler_thread():
-    schedule.every(2).minutes.do(lambda: Thread(target=feed_cat).start())
-    schedule.every(29).minutes.do(lambda: Thread(target=get_prize).start())
-    schedule.every(60).minutes.do(lambda: Thread(target=play_game).start())
-    schedule.every().day.at("02:00").do(lambda: Thread(target=get_daily_prize).start())
+    for index, acc in enumerate(ACCOUNTS):
+        schedule_account(acc, index)
 
-    log("Планировщик запущен")
+    log(f"Планировщик запущен, аккаунтов: {len(ACCOUNTS)}")
     while True:
+        note_missed_runs()
         schedule.run_pending()
         time.sleep(1)
 
+
+# ================= Регистрация в Telegram =================
+BOT_COMMANDS = [
+    {"command": "start", "description": "go"},
+    {"command": "box", "description": "box open"},
+    {"command": "essence", "description": "essence"},
+    {"command": "stats", "description": "loot stats [24h|7d|all]"},
+    {"command": "inventory", "description": "warehouse counts"},
+    {"command": "cancel", "description": "stop /box or /essence"}
+]
+
+
 def set_bot_commands():
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setMyCommands"
-    commands = [
-        {"command": "start", "description": "go"},
-        {"command": "box", "description": "box open"},
-        {"command": "essence", "description": "essence"}
-    ]
+    result = tg_call("setMyCommands", {"commands": BOT_COMMANDS})
+    log(f"Команды меню обновлены: {result}")
+    return result is not None
+
+
+def register_telegram():
+    """setWebhook + setMyCommands, только если что-то изменилось.
+
+    Хеш URL вебхука, команд и токена хранится в TG_REGISTRATION_CACHE;
+    совпал — повторная регистрация при рестарте не нужна.
+    """
+    digest = hashlib.sha256(json.dumps(
+        [TELEGRAM_TOKEN, WEBHOOK_URL, BOT_COMMANDS], sort_keys=True
+    ).encode()).hexdigest()
     try:
-        resp = requests.post(url, json={"commands": commands})
-        log(f"Команды меню обновлены: {resp.json()}")
-    except Exception as e:
-        log(f"Ошибка обновления команд меню: {e}")
+        with open(TG_REGISTRATION_CACHE) as f:
+            if f.read().strip() == digest:
+                log("Webhook и команды не изменились — регистрация пропущена")
+                return
+    except OSError:
+        pass
 
+    result = tg_call("setWebhook", {"url": WEBHOOK_URL})
+    log(f"Webhook set: {result}")
+    if result is None or not set_bot_commands():
+        return
 
-# ================= Initial Cycle =================
-def start_initial_cycle():
-    log("Стартовый цикл…")
-    get_all_stats_before_action()
-    feed_cat()
-    get_prize()
-    play_game()
-    get_daily_prize()
-    log("Стартовый цикл завершён ✓")
+    try:
+        with open(TG_REGISTRATION_CACHE, "w") as f:
+            f.write(digest)
+    except OSError as e:
+        log(f"Не удалось сохранить хеш регистрации: {e}", level="warning")
 
 
 # ================= Flask =================
 app = Flask(__name__)
 
 
+# Повторные доставки одного апдейта (Telegram шлёт их, если мы отвечаем
+# медленно) отбрасываются по update_id. Повтор может прийти в другой воркер,
+# поэтому принятые id лежат в STATE_DB; в памяти — только запасной вариант
+# на случай ошибки БД, он работает лишь в пределах одного процесса.
+_seen_updates = OrderedDict()
+_seen_updates_lock = Lock()
+_seen_updates_inserts = count(1)
+
+# Быстрые команды только читают — у них свой пул, чтобы не стоять в очереди
+# за идущими /box и /essence
+command_executor = ThreadPoolExecutor(
+    max_workers=max(COMMAND_WORKERS, len(ACCOUNTS)), thread_name_prefix="cmd"
+)
+
+
+def is_duplicate_update(update_id):
+    try:
+        conn = db()
+        with _db_lock:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO seen_updates (update_id, ts) VALUES (?, ?)",
+                (update_id, time.time())
+            ).rowcount
+            # Храним последние WEBHOOK_DEDUP_SIZE id; чистим раз в 100 апдейтов
+            if inserted and next(_seen_updates_inserts) % 100 == 0:
+                conn.execute(
+                    "DELETE FROM seen_updates WHERE update_id < (SELECT update_id FROM seen_updates "
+                    "ORDER BY update_id DESC LIMIT 1 OFFSET ?)",
+                    (WEBHOOK_DEDUP_SIZE - 1,)
+                )
+        return not inserted
+    except sqlite3.Error as e:
+        log(f"Не удалось проверить update_id {update_id} в БД: {e}", level="warning")
+    with _seen_updates_lock:
+        if update_id in _seen_updates:
+            _seen_updates.move_to_end(update_id)
+            return True
+        _seen_updates[update_id] = True
+        if len(_seen_updates) > WEBHOOK_DEDUP_SIZE:
+            _seen_updates.popitem(last=False)
+        return False
+
+
+def run_command(accounts, fn, *args):
+    """Выполняет команду в фоне для каждого аккаунта чата."""
+    def wrapper():
+        try:
+            fn(*args)
+        except Exception as e:
+            log(f"Ошибка в команде {fn.__name__}: {e}", level="error")
+
+    for acc in accounts:
+        command_executor.submit(in_account, acc, wrapper)
+
+
+# ================= Команды: один запуск за раз =================
+# /box и /essence для одного аккаунта не запускаются параллельно: два
+# запуска делили бы одни и те же боксы и эссенции. Webhook обслуживают все
+# воркеры gunicorn, поэтому запуск занимает строку в command_runs (STATE_DB):
+# повторная команда в любом воркере получает оттуда статус, а /cancel
+# ставит там флаг, который воркер-владелец проверяет раз в секунду.
+# Долгие команды, которые идут по одной на аккаунт
+LONG_COMMANDS = ("/box", "/essence")
+
+# Каждая долгая команда идёт не больше чем в одном экземпляре на аккаунт,
+# так что поток найдётся всегда
+long_command_executor = ThreadPoolExecutor(
+    max_workers=len(ACCOUNTS) * len(LONG_COMMANDS), thread_name_prefix="long-cmd"
+)
+
+
+class CommandRun:
+    """Идущая в этом процессе команда аккаунта: прогресс и флаг отмены.
+
+    Фоновый поток раз в COMMAND_SYNC_INTERVAL пишет прогресс и отметку
+    в command_runs и забирает оттуда флаг отмены.
+    """
+
+    def __init__(self, account_name, command):
+        self.account_name = account_name
+        self.command = command
+        self.owner = f"{os.getpid()}:{os.urandom(4).hex()}"
+        self.started = time.time()
+        self.progress = "запускается"
+        self.cancel_event = Event()
+        self.done = Event()
+
+    def status(self):
+        return format_run_status(self.progress, self.started)
+
+    def watch(self):
+        while not self.done.wait(COMMAND_SYNC_INTERVAL):
+            try:
+                rows = db_execute(
+                    "UPDATE command_runs SET heartbeat = ?, progress = ? "
+                    "WHERE account = ? AND command = ? AND owner = ? RETURNING cancel",
+                    (time.time(), self.progress, self.account_name, self.command, self.owner)
+                )
+            except sqlite3.Error as e:
+                log(f"Не удалось отметить {self.command}: {e}", level="warning")
+                continue
+            # Строки нет — запуск признали брошенным и его место занял другой
+            if not rows or rows[0][0]:
+                self.cancel_event.set()
+
+
+_command_runs = {}  # (аккаунт, команда) -> CommandRun этого процесса
+_command_runs_lock = Lock()
+
+# Запуск, внутри которого выполняется текущий код (копируется и в gatto_map)
+current_run = ContextVar("current_run", default=None)
+
+
+def format_run_status(progress, started):
+    return f"{progress} ({int(time.time() - started)} с)"
+
+
+def set_progress(text):
+    run = current_run.get()
+    if run is not None:
+        run.progress = text
+
+
+def cancelled():
+    """Попросили ли остановить текущую команду. Вне команд — всегда False."""
+    run = current_run.get()
+    return run is not None and run.cancel_event.is_set()
+
+
+def claim_command(run):
+    """Занимает (аккаунт, команду) во всех воркерах.
+
+    None — запуск наш; иначе (прогресс, начало) уже идущего. Строку с
+    отметкой старше COMMAND_STALE (воркер умер) можно занять заново.
+    """
+    t = time.time()
+    conn = db()
+    with _db_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT progress, started FROM command_runs "
+                "WHERE account = ? AND command = ? AND heartbeat >= ?",
+                (run.account_name, run.command, t - COMMAND_STALE)
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO command_runs "
+                    "(account, command, owner, started, heartbeat, progress, cancel) VALUES (?, ?, ?, ?, ?, ?, 0)",
+                    (run.account_name, run.command, run.owner, run.started, t, run.progress)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return row
+
+
+def release_command(run):
+    try:
+        db_execute(
+            "DELETE FROM command_runs WHERE account = ? AND command = ? AND owner = ?",
+            (run.account_name, run.command, run.owner)
+        )
+    except sqlite3.Error as e:
+        log(f"Не удалось освободить {run.command}: {e}", level="warning")
+
+
+def start_command(accounts, command, fn, ack):
+    """Запускает fn для аккаунтов, у которых command ещё не идёт ни в одном
+    воркере. Возвращает текст ответа: ack для новых запусков, статус — для идущих.
+    """
+    replies = []
+    for acc in accounts:
+        key = (acc.name, command)
+        run = CommandRun(acc.name, command)
+        with _command_runs_lock:
+            local = _command_runs.get(key)
+            if local is None:
+                try:
+                    busy = claim_command(run)
+                except sqlite3.Error as e:
+                    # Без БД остаётся защита только внутри этого процесса
+                    log(f"Не удалось занять {command} в БД: {e}", level="warning")
+                    busy = None
+                if busy is None:
+                    _command_runs[key] = run
+        if local is not None:
+            busy = (local.progress, local.started)
+        if busy is not None:
+            replies.append(acc.tag(f"⏳ {command} уже выполняется: {format_run_status(*busy)}"))
+            continue
+        replies.append(acc.tag(ack))
+
+        def wrapper(run=run, key=key, acc=acc):
+            token = current_run.set(run)
+            trace = start_trace(acc.job_key(command), "command")
+            trace_token = current_trace.set(trace)
+            Thread(target=run.watch, daemon=True, name="cmd-watch").start()
+            outcome = "ok"
+            try:
+                if traced_call(fn) is False:
+                    outcome = "failed"
+            except Exception as e:
+                outcome = f"error: {e}"
+                log(f"Ошибка в команде {command}: {e}", level="error")
+            finally:
+                current_trace.reset(trace_token)
+                finish_trace(trace, "cancelled" if run.cancel_event.is_set() else outcome)
+                current_run.reset(token)
+                run.done.set()
+                release_command(run)
+                with _command_runs_lock:
+                    _command_runs.pop(key, None)
+
+        long_command_executor.submit(in_account, acc, wrapper)
+    return "\n\n".join(replies)
+
+
+def cancel_commands(accounts, command=None):
+    """Просит остановиться идущие команды аккаунтов (все или только command),
+    в каком бы воркере они ни шли."""
+    names = [acc.name for acc in accounts]
+    # Запуски этого процесса останавливаются сразу, не дожидаясь опроса БД
+    with _command_runs_lock:
+        for (name, cmd), run in _command_runs.items():
+            if name in names and command in (None, cmd):
+                run.cancel_event.set()
+    try:
+        rows = db_execute(
+            f"UPDATE command_runs SET cancel = 1 WHERE account IN ({','.join('?' * len(names))}) "
+            "AND (? IS NULL OR command = ?) AND cancel = 0 AND heartbeat >= ? "
+            "RETURNING account, command, progress, started",
+            (*names, command, command, time.time() - COMMAND_STALE)
+        )
+    except sqlite3.Error as e:
+        log(f"Не удалось отменить команды в БД: {e}", level="warning")
+        return "❌ Не удалось отменить: ошибка БД."
+    by_name = {acc.name: acc for acc in accounts}
+    replies = [
+        by_name[name].tag(f"⛔ Останавливаю {cmd}: {format_run_status(progress, started)}")
+        for name, cmd, progress, started in rows
+    ]
+    return "\n\n".join(replies) or "Нечего отменять."
+
+
+def dispatch_command(text, accounts):
+    """Отдаёт команду в фоновый пул. Возвращает текст подтверждения или None."""
+    command, _, arg = text.partition(" ")
+    arg = arg.strip()
+
+    if text == "/essence":
+        return start_command(accounts, "/essence", apply_essences_to_pets, "Начинаю ⚡")
+
+    if text.startswith("/box"):
+        return start_command(accounts, "/box", open_boxes, "📦 Открываю боксы…")
+
+    if command == "/cancel":
+        if arg and f"/{arg.lstrip('/')}" not in LONG_COMMANDS:
+            return "Формат: /cancel [box | essence]"
+        return cancel_commands(accounts, f"/{arg.lstrip('/')}" if arg else None)
+
+    if command == "/inventory":
+        run_command(accounts, send_inventory)
+        return None
+
+    if command == "/stats":
+        run_command(accounts, send_reward_stats, arg)
+        return None
+
+    return None
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def debug_allowed():
+    """Отладочные маршруты открыты только с верным X-Debug-Token."""
+    token = request.headers.get("X-Debug-Token", "")
+    return bool(DEBUG_TOKEN) and hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode())
+
+
+def known_trace_names():
+    """Имена, под которыми пишутся трассы: плановые задачи и долгие команды."""
+    names = {job_name(job) for job in list(schedule.jobs)}
+    names.update(acc.job_key(command) for acc in ACCOUNTS for command in LONG_COMMANDS)
+    return names
+
+
+@app.route("/debug/jobs")
+def debug_jobs():
+    """Последние запуски задач и команд этого процесса: задержка старта,
+    время по фазам, вызовы. ?job=имя, ?limit=N, ?spans=1 — все спаны.
+
+    Планировщик работает только у лидера, команды — у воркера, принявшего
+    webhook; под gunicorn каждый воркер показывает своё.
+    """
+    if not debug_allowed():
+        return "not found", 404
+    snapshot = traces_snapshot(
+        limit=request.args.get("limit", 20, type=int),
+        name=request.args.get("job"),
+        spans=request.args.get("spans") == "1",
+    )
+    snapshot["next_runs"] = {
+        job_name(job): job.next_run.isoformat(timespec="seconds")
+        for job in list(schedule.jobs) if job.next_run
+    }
+    return jsonify(snapshot)
+
+
+@app.route("/debug/profile", methods=["POST"])
+def debug_profile():
+    """Включает сэмплирующий профилировщик на следующий запуск задачи ?job=имя
+    (как в /debug/jobs, например feed_cat или /box). Результат — в /debug/jobs."""
+    if not debug_allowed():
+        return "not found", 404
+    name = request.args.get("job")
+    if name not in known_trace_names():
+        return jsonify({"error": "unknown job"}), 400
+    arm_profile(name)
+    return jsonify({"armed": name})
+
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    data = request.json
-    if not data or "message" not in data:
+    data = request.get_json(silent=True)
+    if not data:
+        return "ok"
+
+    update_id = data.get("update_id")
+    if update_id is not None and is_duplicate_update(update_id):
+        return "ok"
+
+    if "message" not in data:
         return "ok"
 
     msg = data["message"]
     chat_id = msg.get("chat", {}).get("id")
     text = msg.get("text", "")
 
-    if chat_id != CHAT_ID:
+    accounts = ACCOUNTS_BY_CHAT.get(chat_id)
+    if not accounts:
         return "ok"
 
-    if text == "/essence":
-        Thread(target=apply_essences_to_pets).start()
-        send_telegram("Начинаю ⚡")
-
-    # ========== НОВАЯ КОМАНДА /box ==========
-    if text.startswith("/box"):
-        parts = text.split()
-        Thread(target=open_boxes).start()
-        send_telegram(f"📦 Открываю боксы…")
+    ack = dispatch_command(text, accounts)
+    if ack:
+        if TG_REPLY_IN_WEBHOOK:
+            # Подтверждение уходит прямо в ответе на webhook — без своего запроса
+            return jsonify({"method": "sendMessage", "chat_id": chat_id, "text": ack})
+        send_telegram(ack, chat_id)
 
     return "ok"
 
 
+# ================= Лидер =================
+# Под gunicorn с несколькими воркерами каждый импортирует модуль. Webhook
+# обслуживают все, а планировщик и стартовые вызовы — только лидер: тот, кто
+# держит flock на LEADER_LOCK_PATH. Блокировку снимает ОС, когда процесс
+# лидера умирает, и её подхватывает один из ожидающих.
+_leader_fd = None
+
+
+def try_become_leader():
+    try:
+        fd = os.open(LEADER_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        log(f"Не удалось открыть {LEADER_LOCK_PATH}: {e}", level="error")
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    return fd
+
+
+def start_leader_duties():
+    Thread(target=register_telegram, daemon=True).start()
+    Thread(target=scheduler_thread, daemon=True).start()
+
+
+def leader_election():
+    global _leader_fd
+    while True:
+        fd = try_become_leader()
+        if fd is not None:
+            _leader_fd = fd
+            log(f"Процесс {os.getpid()} стал лидером")
+            start_leader_duties()
+            return
+        time.sleep(LEADER_POLL_INTERVAL)
+
+
 # ================= Start =================
+Thread(target=log_writer, daemon=True, name="log-writer").start()
 log("Бот запускается…")
 
-try:
-    wh = requests.get(
-        f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook?url={WEBHOOK_URL}"
-    )
-    log(f"Webhook set: {wh.text}")
-except Exception as e:
-    log(f"Ошибка установки webhook: {e}")
-set_bot_commands()
-
-Thread(target=start_initial_cycle, daemon=True).start()
-Thread(target=scheduler_thread, daemon=True).start()
+Thread(target=telegram_sender, daemon=True, name="tg-sender").start()
+if BOT_ROLE != "web":
+    Thread(target=leader_election, daemon=True, name="leader").start()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080)